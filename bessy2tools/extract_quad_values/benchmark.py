@@ -0,0 +1,105 @@
+# time and peak memory of every stage of mmltools for synthetic LOCO files of growing size
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import scipy.io as sio
+
+from bessy2tools.extract_quad_values import mmltools, synthetic
+from bessy2tools.extract_quad_values.cache import ATRingCache
+
+
+def get_stages(path, cache_dir):
+    """ (name, function(state)) in the order they run, state carries the objects between the stages """
+    def init(state):
+        state['lwa'] = mmltools.ATRingWithAO(path)
+
+    def init_lazy(state):
+        state['lazy'] = mmltools.ATRingWithAO(path, lazy=True)
+
+    def print_ring(state):
+        with open(os.devnull, 'w') as file:
+            mmltools.PrintATRing(state['lwa'].rings[-1].ring[0, :], file=file)
+
+    return [
+        ('loadmat', lambda state: sio.loadmat(path, struct_as_record=False, squeeze_me=False)),
+        ('ATRingWithAO', init),
+        ('ATRingWithAO lazy', init_lazy),
+        ('RingTable', lambda state: mmltools.RingTable.from_ring(state['lwa'].rings[-1].ring[0, :])),
+        ('NameMap', lambda state: state['lwa'].build_name_map(state['lwa'].get_ring_table(-1))),
+        ('get_magnet_strength QUAD', lambda state: state['lwa'].get_magnet_strength('QUAD')),
+        ('get_magnet_strength SEXT', lambda state: state['lwa'].get_magnet_strength('SEXT')),
+        ('get_fit_trajectory', lambda state: state['lwa'].get_fit_trajectory()),
+        ('get_fit_trajectory lazy', lambda state: state['lazy'].get_fit_trajectory()),
+        ('PrintATRing', print_ring),
+        ('cache write', lambda state: ATRingCache(cache_dir).load(path)),
+        ('cache load', lambda state: ATRingCache(cache_dir).load(path)),
+    ]
+
+
+def run_stages(stages, trace_memory=False):
+    """ dict stage -> (seconds, peak MB of memory allocated within the stage or None) """
+    results = {}
+    state = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, stage in stages:
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            stage(state)
+            seconds = time.perf_counter() - start
+            peak = None
+            if trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+            results[name] = (seconds, peak)
+    return results
+
+
+def benchmark(machine, n_sectors, n_fit_iterations, repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'ATRingWithAO.mat')
+        synthetic.write_at_ring_with_ao(path, machine, n_sectors, n_fit_iterations, seed=0)
+        size = os.path.getsize(path) / 2 ** 20
+
+        times = {}
+        for i in range(repeat):
+            cache_dir = os.path.join(directory, f'cache{i}')
+            for name, (seconds, _) in run_stages(get_stages(path, cache_dir)).items():
+                times[name] = min(seconds, times.get(name, seconds))
+        memory = run_stages(get_stages(path, os.path.join(directory, 'cache_memory')), trace_memory=True)
+        n_elements = len(mmltools.LazyRings(path)[-1].ring[0, :])
+
+    for name, seconds in times.items():
+        yield dict(machine=machine, sectors=n_sectors, elements=n_elements, fit_iterations=n_fit_iterations,
+                   file_MB=round(size, 3), stage=name, time_s=seconds, peak_MB=memory[name][1])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark mmltools on synthetic LOCO files.')
+    parser.add_argument('--machine', default='BESSYII', choices=sorted(synthetic.SECTORS))
+    parser.add_argument('--sectors', type=int, nargs='+', default=[8, 16, 32], help='ring sizes, BESSY II has 16')
+    parser.add_argument('--fit-iterations', type=int, nargs='+', default=[5, 21])
+    parser.add_argument('--repeat', type=int, default=3, help='the best time of repeat runs is reported')
+    parser.add_argument('-o', '--output', help='append the results to a file (JSON Lines)')
+    args = parser.parse_args(args)
+
+    with contextlib.ExitStack() as stack:
+        output = stack.enter_context(open(args.output, 'a')) if args.output else None
+        print(f'{"sectors":>7} {"elements":>8} {"iterations":>10} {"stage":26} {"time / ms":>10} {"peak / MB":>10}')
+        for n_sectors in args.sectors:
+            for n_fit_iterations in args.fit_iterations:
+                for row in benchmark(args.machine, n_sectors, n_fit_iterations, args.repeat):
+                    print(f'{row["sectors"]:7} {row["elements"]:8} {row["fit_iterations"]:10} {row["stage"]:26} '
+                          f'{1e3 * row["time_s"]:10.2f} {row["peak_MB"]:10.2f}')
+                    if output:
+                        output.write(json.dumps(row) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import scipy.io as sio
+
+from bessy2tools.extract_quad_values import mmltools
+
+DEFAULT_CACHE_DIR = Path(os.environ.get('BESSY2TOOLS_CACHE', '~/.cache/bessy2tools/atring')).expanduser()
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+
+
+def _save_arrays(directory, arrays):
+    for name, array in arrays.items():
+        np.save(directory / f'{name}.npy', array)
+
+
+def _load_arrays(directory):
+    """ arrays are memory mapped, nothing is read until they are used """
+    return {path.stem: np.load(path, mmap_mode='r') for path in directory.glob('*.npy')}
+
+
+def _get_mtime(path):
+    """ None if the path was removed meanwhile, e.g. evicted by another process using the same cache """
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def _get_file_size(path):
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def _touch(path):
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _write_atomic(target, write):
+    """ write into a temporary directory which is renamed to target, a concurrent writer of the same entry wins """
+    tmp = Path(tempfile.mkdtemp(dir=target.parent, prefix='.tmp-'))
+    try:
+        write(tmp)
+        os.replace(tmp, target)
+    except OSError:
+        if not target.exists():
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+class CachedATRingWithAO(mmltools.ATRingWithAO):
+    """
+    ATRingWithAO restored from the cache: NameMap and the ring tables of already extracted fit iterations are
+    memory mapped, the .mat file is only opened for fit iterations which are not cached yet or when ao, ad or rings
+    are accessed
+    """
+
+    def __init__(self, filename, entry, cache=None):
+        self.filename = filename
+        self.entry = entry
+        self.cache = cache
+        meta = json.loads((entry / 'meta.json').read_text())
+        self.machine = meta['machine']
+        self.n_fit_iterations = meta['n_fit_iterations']
+        self.n_at_elements = meta['n_at_elements']
+        self.name_map = mmltools.NameMap(self.n_at_elements)
+        for column, array in _load_arrays(entry / 'name_map').items():
+            setattr(self.name_map, column, array)
+        self.ring_tables = {}
+        self._mat_dict = self._rings = None
+
+    @property
+    def mat_dict(self):
+        if self._mat_dict is None:
+            self._mat_dict = sio.loadmat(self.filename, struct_as_record=False, squeeze_me=False,
+                                         variable_names=('ao', 'ad'))
+        return self._mat_dict
+
+    @property
+    def ao(self):
+        return self.mat_dict['ao'][0][0]
+
+    @property
+    def ad(self):
+        return self.mat_dict['ad'][0][0]
+
+    @property
+    def rings(self):
+        if self._rings is None:
+            self._rings = mmltools.LazyRings(self.filename)
+        return self._rings
+
+    def get_ring_table(self, fit_iteration=-1):
+        fit_iteration %= self.n_fit_iterations
+        if fit_iteration not in self.ring_tables:
+            directory = self.entry / f'ring_{fit_iteration}'
+            if directory.exists():
+                arrays = _load_arrays(directory)
+                valid = {column: arrays.pop('valid_' + column) for column in mmltools.RingTable.fields}
+                self.ring_tables[fit_iteration] = mmltools.RingTable(valid=valid, **arrays)
+            else:
+                table = super().get_ring_table(fit_iteration)
+                # the entry may have been evicted by another process meanwhile, then the table is just not cached
+                if (self.entry / 'meta.json').exists():
+                    try:
+                        ATRingCache.write_ring_table(directory, table)
+                    except OSError:
+                        pass
+                if self.cache is not None:
+                    _touch(self.entry)
+                    self.cache.evict(keep=self.entry)
+        return self.ring_tables[fit_iteration]
+
+
+class ATRingCache:
+    """
+    On-disk cache of parsed ATRingWithAO files, keyed by content hash and parser version.
+    Each entry is a directory of .npy files. Entries and the remembered file hashes are touched on every access and
+    the least recently used ones are evicted when the cache grows above max_size bytes.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        (self.directory / 'hashes').mkdir(parents=True, exist_ok=True)
+
+    def get_hash(self, filename):
+        """ sha256 of the file content, remembered per path, size and mtime so unchanged files are not read again """
+        stat = os.stat(filename)
+        key = f'{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}'
+        memo = self.directory / 'hashes' / hashlib.sha256(key.encode()).hexdigest()
+        try:
+            hexdigest = memo.read_text()
+            _touch(memo)
+            return hexdigest
+        except FileNotFoundError:
+            pass
+
+        sha256 = hashlib.sha256()
+        with open(filename, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                sha256.update(chunk)
+        memo.write_text(sha256.hexdigest())
+        return sha256.hexdigest()
+
+    def get_entry(self, filename):
+        return self.directory / f'{self.get_hash(filename)}-v{mmltools.PARSER_VERSION}'
+
+    def load(self, filename):
+        """ returns a CachedATRingWithAO, the file is parsed only if it is not in the cache """
+        entry = self.get_entry(filename)
+        if not entry.exists():
+            lwa = mmltools.ATRingWithAO(filename, lazy=True)
+            _write_atomic(entry, lambda tmp: self._write_entry(tmp, filename, lwa))
+        # touched before evicting, so that it is the most recently used entry for other processes as well
+        _touch(entry)
+        self.evict(keep=entry)
+        return CachedATRingWithAO(filename, entry, self)
+
+    @staticmethod
+    def _write_entry(directory, filename, lwa):
+        meta = dict(filename=os.path.abspath(filename), machine=lwa.machine,
+                    n_fit_iterations=lwa.n_fit_iterations, n_at_elements=lwa.n_at_elements,
+                    parser_version=mmltools.PARSER_VERSION)
+        (directory / 'meta.json').write_text(json.dumps(meta, indent=2))
+        (directory / 'name_map').mkdir()
+        _save_arrays(directory / 'name_map', {column: getattr(lwa.name_map, column) for column in lwa.name_map._columns})
+        for fit_iteration, table in lwa.ring_tables.items():
+            ATRingCache.write_ring_table(directory / f'ring_{fit_iteration}', table)
+
+    @staticmethod
+    def write_ring_table(directory, table):
+        def write(tmp):
+            _save_arrays(tmp, {column: getattr(table, column) for column in mmltools.RingTable.columns})
+            _save_arrays(tmp, {'valid_' + column: mask for column, mask in table.valid.items()})
+
+        _write_atomic(directory, write)
+
+    def get_size(self, entry):
+        return sum(_get_file_size(path) for path in entry.rglob('*') if path.is_file())
+
+    def evict(self, keep=None):
+        """
+        entries and hash memos by last access, memos of evicted entries are of no use and removed with them
+        keep: entry in use which is never evicted, even if it alone is larger than max_size
+        other processes may evict from the same directory at the same time, paths which disappear are skipped
+        """
+        entries = [entry for entry in self.directory.glob('*-v*') if entry.is_dir()]
+        memos = [memo for memo in (self.directory / 'hashes').iterdir() if memo.is_file()]
+        sizes = {entry: self.get_size(entry) for entry in entries}
+        sizes.update((memo, _get_file_size(memo)) for memo in memos)
+        total_size = sum(sizes.values())
+        mtimes = {path: _get_mtime(path) for path in sizes}
+        evicted_hashes = set()
+        for path in sorted((path for path in sizes if mtimes[path] is not None), key=mtimes.get):
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+                evicted_hashes.add(path.name.rsplit('-v', 1)[0])
+            else:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+            total_size -= sizes.pop(path)
+        for memo in memos:
+            try:
+                if memo in sizes and memo.read_text() in evicted_hashes:
+                    memo.unlink()
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        (self.directory / 'hashes').mkdir(parents=True, exist_ok=True)
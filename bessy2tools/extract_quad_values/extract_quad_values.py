@@ -1,24 +1,103 @@
-import mmltools
-import sys, json
-
-with open('b2_template.json') as file:
-    template_lattice = json.load(file)
-
-if len(sys.argv) > 1:
-    paths = sys.argv[1:]
-else:
-    print('DEBUG')
-    paths = ['ATRingWithAO.mat']
-
-for path in paths:
-    print(path)
-    lwa = mmltools.ATRingWithAO(path)
-    quads = lwa.get_magnet_strength(at_type='QUAD', method='byPowerSupply')
-    # sexts = lwa.get_magnet_strength(at_type='SEXT', method='byPowerSupply')
-
-    new_lattice = template_lattice.copy()
-    new_lattice['elements'] = {**quads, **template_lattice['elements']}
-    print(f'extracted quad_values for {path}')
-    print(json.dumps(new_lattice, indent=2))
-    with open(f'{path}_lattice.json', 'w') as file:
-        json.dump(new_lattice, file, indent=2)
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from bessy2tools.extract_quad_values import mmltools
+from bessy2tools.extract_quad_values.cache import ATRingCache, DEFAULT_CACHE_DIR
+
+TEMPLATE_PATH = Path(__file__).resolve().parent / 'b2_template.json'
+
+
+def extract(path, at_types=('QUAD',), fit_iteration=-1, cache_dir=DEFAULT_CACHE_DIR):
+    """ runs in a worker process, returns the magnet strengths and everything mmltools printed """
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        lwa = ATRingCache(cache_dir).load(path) if cache_dir else mmltools.ATRingWithAO(path, lazy=True)
+        elements = {}
+        for at_type in at_types:
+            elements.update(lwa.get_magnet_strength(at_type=at_type, fit_iteration=fit_iteration))
+    return dict(machine=lwa.machine, elements=elements, log=log.getvalue())
+
+
+def extract_all(paths, workers=None, **kwargs):
+    """ yields (path, result, error) in the order the files are finished """
+    if workers == 1:
+        for path in paths:
+            try:
+                yield path, extract(path, **kwargs), None
+            except Exception:
+                yield path, None, traceback.format_exc()
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(extract, path, **kwargs): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception:
+                yield futures[future], None, traceback.format_exc()
+
+
+def table_rows(path, result):
+    for name, attributes in result['elements'].items():
+        strength = attributes.get('k1', attributes.get('k2'))
+        length = attributes['length']
+        yield dict(path=path, machine=result['machine'], name=name, type=attributes['type'],
+                   length=length if not isinstance(length, dict) else None, strength=float(strength))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Extract magnet strengths from LOCO files in ATRingWithAO format.')
+    parser.add_argument('paths', nargs='+', help='.mat files')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--at-types', nargs='+', default=['QUAD'], choices=['QUAD', 'SEXT'])
+    parser.add_argument('--fit-iteration', type=int, default=-1)
+    parser.add_argument('--template', default=TEMPLATE_PATH, help='lattice file the extracted values are merged into')
+    parser.add_argument('--no-lattice-files', action='store_true', help='do not write <path>_lattice.json')
+    parser.add_argument('-o', '--output', help='write one combined table (JSON Lines, one row per magnet)')
+    parser.add_argument('--print', action='store_true', help='dump each lattice to stdout')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the output of mmltools')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args(args)
+
+    with open(args.template) as file:
+        template_lattice = json.load(file)
+
+    n_errors = 0
+    with contextlib.ExitStack() as stack:
+        table = stack.enter_context(open(args.output, 'w')) if args.output else None
+        results = extract_all(args.paths, workers=args.workers, at_types=tuple(args.at_types),
+                              fit_iteration=args.fit_iteration, cache_dir=None if args.no_cache else args.cache_dir)
+        for i, (path, result, error) in enumerate(results, 1):
+            if error:
+                n_errors += 1
+                print(f'[{i}/{len(args.paths)}] {path}: ERROR\n{error}', file=sys.stderr)
+                if table:
+                    table.write(json.dumps(dict(path=path, error=error.strip().splitlines()[-1])) + '\n')
+                continue
+
+            print(f'[{i}/{len(args.paths)}] extracted {len(result["elements"])} magnet values for {path}', file=sys.stderr)
+            if args.verbose:
+                print(result['log'], file=sys.stderr)
+            new_lattice = template_lattice.copy()
+            new_lattice['elements'] = {**result['elements'], **template_lattice['elements']}
+            if args.print:
+                print(json.dumps(new_lattice, indent=2))
+            if not args.no_lattice_files:
+                with open(f'{path}_lattice.json', 'w') as file:
+                    json.dump(new_lattice, file, indent=2)
+            if table:
+                table.writelines(json.dumps(row) + '\n' for row in table_rows(path, result))
+
+    return 1 if n_errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
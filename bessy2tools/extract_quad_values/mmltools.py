@@ -1,6 +1,22 @@
+import csv
+import io
+import json
+import struct
+import sys
+import zlib
+
 import numpy as np
 import scipy.io as sio
 
+from bessy2tools.instrumentation import metrics
+
+# MAT-file v5 data types
+miINT8, miINT32, miUINT32, miMATRIX, miCOMPRESSED = 1, 5, 6, 14, 15
+mxSTRUCT_CLASS = 2
+
+# bump whenever the parsing changes, invalidates cached files
+PARSER_VERSION = 1
+
 
 class NameMap:
     """
@@ -10,7 +26,10 @@ class NameMap:
     NOTE: ao_indices is not unique but is defined in each family (for each at_names)
     """
 
+    _columns = ('at_indices', 'ao_indices', 'at_types', 'at_names', 'ao_names', 'ps_names')
+
     def __init__(self, N):
+        self._index = {}
         self.N = N
         self.at_indices = np.zeros(N, dtype=int)
         self.ao_indices = np.zeros(N, dtype=int)
@@ -19,23 +38,75 @@ class NameMap:
         self.ao_names = np.array([''] * N, dtype="U40")
         self.ps_names = np.array([''] * N, dtype="U40")
 
+    def __setattr__(self, key, value):
+        if key in self._columns:
+            self.invalidate_index()
+        super().__setattr__(key, value)
+
+    def invalidate_index(self):
+        """ has to be called after the columns were changed in place, the index is rebuilt on the next lookup """
+        self._index = {}
+
+    def _get_index(self, column):
+        """
+        inverted index of a name column: name -> position of its group, at_indices sorted by group, group bounds
+        built once with a stable argsort, so the at_indices of each group keep their order
+        """
+        index = self._index.get(column)
+        if index is None:
+            names, inverse = self._get_codes(column)
+            order = np.argsort(inverse, kind='stable')
+            bounds = np.zeros(len(names) + 1, dtype=int)
+            np.cumsum(np.bincount(inverse, minlength=len(names)), out=bounds[1:])
+            at_indices = self.at_indices[order]
+            at_indices.flags.writeable = False
+            index = self._index[column] = (dict(zip(names.tolist(), range(len(names)))), at_indices, bounds)
+        return index
+
+    def _get_codes(self, column):
+        """ sorted unique names of a column and the position of each row's name in them """
+        return np.unique(getattr(self, column), return_inverse=True)
+
+    def _get_at_indices(self, column, name):
+        positions, at_indices, bounds = self._get_index(column)
+        i = positions.get(name)
+        if i is None:
+            return at_indices[:0]
+        return at_indices[bounds[i]:bounds[i + 1]]
+
     def get_at_indices_by_ao_names(self, name):
-        return self.at_indices[self.ao_names == name]
+        return self._get_at_indices('ao_names', name)
 
     def get_at_indices_by_ps_names(self, name):
-        return self.at_indices[self.ps_names == name]
+        return self._get_at_indices('ps_names', name)
 
     def get_at_indices_by_at_names(self, name):
-        return self.at_indices[self.at_names == name]
+        return self._get_at_indices('at_names', name)
+
+    def get_at_indices_grouped(self, by='ps_names', at_type='QUAD'):
+        """ all groups of an at_type at once: dict name -> at_indices, e.g. every power supply with its magnets """
+        positions, at_indices, bounds = self._get_index(by)
+        names = {'ps_names': self.get_ps_names, 'ao_names': self.get_ao_names, 'at_names': self.get_at_names}[by]
+        groups = {}
+        for name in names(at_type=at_type).tolist():
+            i = positions[name]
+            groups[name] = at_indices[bounds[i]:bounds[i + 1]]
+        return groups
+
+    def _get_names(self, column, at_type):
+        return np.unique(getattr(self, column)[self.at_types == at_type])
 
     def get_ps_names(self, at_type='QUAD'):
-        return np.unique(self.ps_names[self.at_types == at_type])
+        return self._get_names('ps_names', at_type)
 
     def get_ao_names(self, at_type='QUAD'):
-        return np.unique(self.ao_names[self.at_types == at_type])
+        return self._get_names('ao_names', at_type)
 
     def get_at_names(self, at_type='QUAD'):
-        return np.unique(self.at_names[self.at_types == at_type])
+        return self._get_names('at_names', at_type)
+
+    def to_categorical(self):
+        return CategoricalNameMap(self)
 
     def print_name_map(self, n_max=None):
         print(f'{"index":5} {"at_indices":5} {"ao_indices":5}  {"at_names":12}    {"ao_names":12}   '
@@ -45,58 +116,364 @@ class NameMap:
                   f'{self.ao_names[i]:12}   {self.ps_names[i]:20}   {self.at_types[i]:20}')
 
 
+class CategoricalNameMap(NameMap):
+    """
+    NameMap with each name column stored as small int codes into a sorted table of its unique names
+    lookups and the names per at_type work on the codes only, the full string columns are decoded on access
+    """
+
+    _name_columns = ('at_types', 'at_names', 'ao_names', 'ps_names')
+
+    def __init__(self, name_map):
+        self._index = {}
+        self.N = name_map.N
+        self.at_indices = name_map.at_indices
+        self.ao_indices = name_map.ao_indices
+        self.categories = {}
+        self.codes = {}
+        for column in self._name_columns:
+            categories, codes = np.unique(getattr(name_map, column), return_inverse=True)
+            self.categories[column] = categories.astype(f'U{max(1, np.char.str_len(categories).max(initial=0))}')
+            self.codes[column] = codes.astype(np.min_scalar_type(max(len(categories) - 1, 0)))
+
+        # names per at_type from the unique (at_type, name) code pairs
+        at_type_codes = self.codes['at_types'].astype(int)
+        self.names_by_type = {}
+        for column in self._name_columns[1:]:
+            n_categories = len(self.categories[column])
+            pairs = np.unique(at_type_codes * n_categories + self.codes[column])
+            self.names_by_type[column] = {
+                at_type: self.categories[column][pairs[pairs // n_categories == i] % n_categories]
+                for i, at_type in enumerate(self.categories['at_types'].tolist())}
+
+    def __setattr__(self, key, value):
+        if key in self._name_columns:
+            raise AttributeError(f'{key} of a CategoricalNameMap is read only')
+        super().__setattr__(key, value)
+
+    def _decode(self, column):
+        return self.categories[column][self.codes[column]]
+
+    at_types = property(lambda self: self._decode('at_types'))
+    at_names = property(lambda self: self._decode('at_names'))
+    ao_names = property(lambda self: self._decode('ao_names'))
+    ps_names = property(lambda self: self._decode('ps_names'))
+
+    def _get_codes(self, column):
+        return self.categories[column], self.codes[column]
+
+    def _get_names(self, column, at_type):
+        return self.names_by_type[column].get(at_type, self.categories[column][:0])
+
+
+class RingTable:
+    """
+    Columnar representation of a MatLab AT RING, decoded once from the element structs
+    s is the position at the end of each element, missing fields are NaN and marked in valid
+    """
+
+    columns = ('name', 'pass_method', 'length', 'K', 'polynom_b', 'bending_angle', 'entrance_angle', 'exit_angle')
+    fields = {'length': 'Length', 'K': 'K', 'polynom_b': 'PolynomB', 'bending_angle': 'BendingAngle',
+              'entrance_angle': 'EntranceAngle', 'exit_angle': 'ExitAngle'}
+
+    def __init__(self, name, pass_method, length, K, polynom_b, bending_angle, entrance_angle, exit_angle, valid):
+        self.name = name
+        self.pass_method = pass_method
+        self.length = length
+        self.K = K
+        self.polynom_b = polynom_b
+        self.bending_angle = bending_angle
+        self.entrance_angle = entrance_angle
+        self.exit_angle = exit_angle
+        self.valid = valid
+        self.s = np.cumsum(length)
+
+    @classmethod
+    def from_ring(cls, r):
+        n = len(r)
+        names, pass_methods = [], []
+        values = {column: np.full(n, np.nan) for column in cls.fields if column != 'polynom_b'}
+        polynom_b = []
+        for i, x in enumerate(r):
+            element = x[0, 0]
+            names.append(element.FamName[0])
+            pass_methods.append(element.PassMethod[0])
+            for column, field in cls.fields.items():
+                value = getattr(element, field, None)
+                if column == 'polynom_b':
+                    polynom_b.append(value[0] if value is not None else ())
+                elif value is not None and value.size:
+                    values[column][i] = value[0, 0]
+
+        n_orders = max(map(len, polynom_b), default=0)
+        values['polynom_b'] = np.full((n, n_orders), np.nan)
+        for i, row in enumerate(polynom_b):
+            values['polynom_b'][i, :len(row)] = row
+
+        valid = {column: ~np.isnan(values[column]) for column in values}
+        valid['polynom_b'] = np.array([len(row) > 0 for row in polynom_b], dtype=bool)
+        values['length'][~valid['length']] = 0
+        return cls(np.array(names), np.array(pass_methods), valid=valid, **values)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            valid = {column: npz['valid_' + column] for column in cls.fields}
+            return cls(valid=valid, **{column: npz[column] for column in cls.columns})
+
+    def save(self, path):
+        np.savez(path, **{column: getattr(self, column) for column in self.columns},
+                 **{'valid_' + column: mask for column, mask in self.valid.items()})
+
+    def __len__(self):
+        return len(self.name)
+
+    @property
+    def s_start(self):
+        return self.s - self.length
+
+    def get_polynom_b(self, order):
+        if order < self.polynom_b.shape[1]:
+            return self.polynom_b[:, order]
+        return np.full(len(self), np.nan)
+
+    def get_strengths(self, at_type):
+        """
+        K (QUAD, PolynomB[0, 1] if an element has no K, as AT does) or PolynomB[0, 2] (SEXT) of every element,
+        NaN if the element has none
+        """
+        if at_type == 'QUAD':
+            return np.where(self.valid['K'], self.K, self.get_polynom_b(1))
+        return {'SEXT': lambda: self.get_polynom_b(2)}[at_type]()
+
+    def get_strengths_of(self, at_type, at_indices):
+        """ strengths of the given elements, raises if one of them has no strength """
+        values = self.get_strengths(at_type)[at_indices]
+        missing = np.isnan(values)
+        if missing.any():
+            names = [f'{self.name[i]} (index {i})' for i in np.asarray(at_indices)[missing][:10]]
+            raise Exception(f'No {at_type} strength (K / PolynomB) for the elements: {", ".join(names)}')
+        return values
+
+
 class PrintATRing:
-    """ can deal with a MatLab AT RING objection """
-
-    def __init__(self, r, details='default'):
-        nat_elements = len(r)
-        s = 0
-        for i in range(nat_elements):
-            name = r[i][0, 0].FamName[0]
-            type_name = r[i][0, 0].PassMethod[0]
-            l = r[i][0, 0].Length[0, 0]
-            s = s + l
-            if i >= 0:  # s <= 320 and
-                extra = ''
-                if type_name in ('StrMPoleSymplectic4Pass', 'StrMPoleSymplectic4RadPass'):
-                    try:
-                        K = r[i][0, 0].K[0, 0]
-                        extra += f' K = {K:11.8f}'
-                    except:
-                        K = r[i][0, 0].PolynomB[0, 2]
-                        extra += f' PolynomB[0,2] = {K:11.8f}'
-                if type_name in ('ThinMPolePass'):
-                    K = r[i][0, 0].PolynomB[0, 2]
-                    extra += f' PolynomB[0,2] = {K:11.8f}'
-                if type_name in ('BndMPoleSymplectic4Pass', 'BndMPoleSymplectic4RadPass'):
-                    BendingAngle = r[i][0, 0].BendingAngle[0, 0]
-                    EntranceAngle = r[i][0, 0].EntranceAngle[0, 0]
-                    ExitAngle = r[i][0, 0].ExitAngle[0, 0]
-                    extra += f' BendingAngle = {BendingAngle:11.8f} EntranceAngle = {EntranceAngle:11.8f} ExitAngle = {ExitAngle:11.8f}'
-
-                if extra == '' and details == 'default':
-                    continue
-                print(f'start: {s - l:12.6f} - {s:10.6f}   length: {l:10.5f}   ', f'{i:5n} {name:12}  {type_name:20}',
-                      extra)
-
-        print(f'Total length: {s:12.6f}')
+    """
+    can deal with a MatLab AT RING objection or a RingTable
+    iter_rows yields the elements as dicts, filtered by s range and pass methods before anything is formatted,
+    write_rows writes them as text (the classic print out), csv or jsonl with buffered writes
+    """
+
+    multipole_fields = ('K', 'PolynomB[0,2]', 'BendingAngle', 'EntranceAngle', 'ExitAngle')
+    row_fields = ('index', 's_start', 's_end', 'length', 'name', 'pass_method') + multipole_fields
+
+    def __init__(self, r, details='default', s_min=None, s_max=None, pass_methods=None, file=None, format='text',
+                 write=True):
+        self.table = r if isinstance(r, RingTable) else RingTable.from_ring(r)
+        if write:
+            rows = self.iter_rows(details=details, s_min=s_min, s_max=s_max, pass_methods=pass_methods)
+            self.write_rows(rows, file=file, format=format)
+
+    def iter_rows(self, details='default', s_min=None, s_max=None, pass_methods=None):
+        """ details='default' only yields elements with multipole fields, s range refers to start and end of element """
+        table = self.table
+        is_multipole = np.isin(table.pass_method, ('StrMPoleSymplectic4Pass', 'StrMPoleSymplectic4RadPass'))
+        is_bend = np.isin(table.pass_method, ('BndMPoleSymplectic4Pass', 'BndMPoleSymplectic4RadPass'))
+        with_k = is_multipole & table.valid['K']
+        with_polynom_b = (is_multipole & ~table.valid['K']) | (table.pass_method == 'ThinMPolePass')
+
+        selection = np.ones(len(table), dtype=bool) if details != 'default' else with_k | with_polynom_b | is_bend
+        s_start = table.s_start
+        if s_min is not None:
+            selection &= s_start >= s_min
+        if s_max is not None:
+            selection &= table.s <= s_max
+        if pass_methods is not None:
+            selection &= np.isin(table.pass_method, pass_methods)
+
+        indices = np.flatnonzero(selection)
+        columns = (indices, s_start[indices], table.s[indices], table.length[indices], table.name[indices],
+                   table.pass_method[indices],
+                   np.where(with_k, table.K, np.nan)[indices],
+                   np.where(with_polynom_b, table.get_polynom_b(2), np.nan)[indices],
+                   *(np.where(is_bend, column, np.nan)[indices]
+                     for column in (table.bending_angle, table.entrance_angle, table.exit_angle)))
+        for values in zip(*(column.tolist() for column in columns)):
+            row = dict(zip(self.row_fields, values))
+            for field in self.multipole_fields:
+                if row[field] != row[field]:  # NaN: field does not apply to this element
+                    row[field] = None
+            yield row
+
+    @staticmethod
+    def format_row(row):
+        extra = ''
+        if row['K'] is not None:
+            extra += f' K = {row["K"]:11.8f}'
+        if row['PolynomB[0,2]'] is not None:
+            extra += f' PolynomB[0,2] = {row["PolynomB[0,2]"]:11.8f}'
+        if row['BendingAngle'] is not None:
+            extra += f' BendingAngle = {row["BendingAngle"]:11.8f} EntranceAngle = {row["EntranceAngle"]:11.8f}' \
+                     f' ExitAngle = {row["ExitAngle"]:11.8f}'
+        return f'start: {row["s_start"]:12.6f} - {row["s_end"]:10.6f}   length: {row["length"]:10.5f}    ' \
+               f'{row["index"]:5n} {row["name"]:12}  {row["pass_method"]:20} {extra}\n'
+
+    def write_rows(self, rows, file=None, format='text', buffer_size=1000):
+        file = file if file is not None else sys.stdout
+        if format == 'text':
+            to_line = self.format_row
+        elif format == 'jsonl':
+            to_line = lambda row: json.dumps(row) + '\n'
+        elif format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, self.row_fields, lineterminator='\n')
+            writer.writeheader()
+            file.write(buffer.getvalue())
+
+            def to_line(row):
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerow(row)
+                return buffer.getvalue()
+        else:
+            raise Exception(f'Unknown format {format}.')
+
+        lines = []
+        for row in rows:
+            lines.append(to_line(row))
+            if len(lines) >= buffer_size:
+                file.write(''.join(lines))
+                lines.clear()
+        file.write(''.join(lines))
+        if format == 'text':
+            file.write(f'Total length: {self.table.s[-1] if len(self.table) else 0:12.6f}\n')
+
+
+def _read_tag(buffer, pos, byte_order):
+    """ returns data type, number of bytes, start of data and start of next element """
+    mdtype, nbytes = struct.unpack_from(byte_order + 'II', buffer, pos)
+    if mdtype >> 16:  # small data element format: data is packed into the tag
+        return mdtype & 0xffff, mdtype >> 16, pos + 4, pos + 8
+    return mdtype, nbytes, pos + 8, pos + 8 + nbytes + (-nbytes % 8)
+
+
+class LazyRings:
+    """
+    The RINGs struct array of a MAT-file (v5), each fit iteration is only decoded when accessed.
+    The variable is decompressed once and kept as raw bytes, the elements of all other fit iterations are skipped
+    by their byte count. An accessed fit iteration is repacked as a MAT-file of its own and decoded by loadmat.
+    """
+
+    def __init__(self, filename, variable_name='RINGs'):
+        self.cache = {}
+        with open(filename, 'rb') as file:
+            self.header = file.read(128)
+            self.byte_order = '<' if self.header[126:128] == b'IM' else '>'
+            self.matrix = self._find_variable(file, variable_name)
+
+        # array flags, dimensions, name, field name length, field names
+        pos = 8
+        mdtype, nbytes, start, pos = _read_tag(self.matrix, pos, self.byte_order)
+        flags = struct.unpack_from(self.byte_order + 'I', self.matrix, start)[0]
+        if flags & 0xff != mxSTRUCT_CLASS:
+            raise Exception(f'{variable_name} is not a struct array.')
+        mdtype, nbytes, start, pos = _read_tag(self.matrix, pos, self.byte_order)
+        dims = struct.unpack_from(f'{self.byte_order}{nbytes // 4}i', self.matrix, start)
+        mdtype, nbytes, start, pos = _read_tag(self.matrix, pos, self.byte_order)
+        fields_start = pos
+        mdtype, nbytes, start, pos = _read_tag(self.matrix, pos, self.byte_order)
+        field_name_length = struct.unpack_from(self.byte_order + 'i', self.matrix, start)[0]
+        mdtype, nbytes, start, pos = _read_tag(self.matrix, pos, self.byte_order)
+        self.n_fields = nbytes // field_name_length
+        self.field_names = self.matrix[fields_start:pos]
+
+        # only collect the offsets of the element structs, nothing is decoded here
+        self.offsets = []
+        for _ in range(int(np.prod(dims))):
+            self.offsets.append(pos)
+            for _ in range(self.n_fields):
+                pos = _read_tag(self.matrix, pos, self.byte_order)[3]
+        self.offsets.append(pos)
+
+    def _find_variable(self, file, variable_name):
+        while True:
+            tag = file.read(8)
+            if len(tag) < 8:
+                raise KeyError(f'Variable {variable_name} not found.')
+            mdtype, nbytes = struct.unpack(self.byte_order + 'II', tag)
+            data = file.read(min(nbytes, 512))
+            if mdtype == miCOMPRESSED:
+                matrix = zlib.decompressobj().decompress(data, 512)
+            else:
+                matrix, nbytes = tag + data, nbytes + (-nbytes % 8)
+
+            # name is the third sub element of the matrix
+            pos = 8
+            for _ in range(3):
+                mdtype, name_length, start, pos = _read_tag(matrix, pos, self.byte_order)
+            if matrix[start:start + name_length].decode() != variable_name:
+                file.seek(nbytes - len(data), 1)
+                continue
+
+            data += file.read(nbytes - len(data))
+            return zlib.decompress(data) if matrix[:8] != tag else tag + data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, fit_iteration):
+        if not -len(self) <= fit_iteration < len(self):
+            raise IndexError('fit iteration out of range')
+        fit_iteration %= len(self)
+        if fit_iteration not in self.cache:
+            name = b'RING'
+            content = b''.join((
+                self.matrix[8:24],  # array flags
+                struct.pack(self.byte_order + 'IIii', miINT32, 8, 1, 1),
+                struct.pack(self.byte_order + 'I', len(name) << 16 | miINT8) + name,  # small data element
+                self.field_names,
+                self.matrix[self.offsets[fit_iteration]:self.offsets[fit_iteration + 1]],
+            ))
+            mat_file = self.header + struct.pack(self.byte_order + 'II', miMATRIX, len(content)) + content
+            mat_dict = sio.loadmat(io.BytesIO(mat_file), struct_as_record=False, squeeze_me=False)
+            self.cache[fit_iteration] = mat_dict['RING'][0, 0]
+        return self.cache[fit_iteration]
 
 
 class ATRingWithAO:
-    def __init__(self, filename):
+    def __init__(self, filename, lazy=False, categorical=False):
+        """
+        lazy: only decode ao and ad, each fit iteration of RINGs is decoded when it is accessed
+        categorical: store the name_map as CategoricalNameMap
+        """
         # struct_as_record=False preserves nested dictionaries!
-        self.mat_dict = sio.loadmat(filename, struct_as_record=False, squeeze_me=False)
+        with metrics.timer('stage_seconds', stage='loadmat'):
+            if lazy:
+                self.mat_dict = sio.loadmat(filename, struct_as_record=False, squeeze_me=False,
+                                            variable_names=('ao', 'ad'))
+                self.rings = LazyRings(filename)
+            else:
+                self.mat_dict = sio.loadmat(filename, struct_as_record=False, squeeze_me=False)
+                self.rings = self.mat_dict['RINGs'][0, :]
 
         self.ao = self.mat_dict['ao'][0][0]
         self.ad = self.mat_dict['ad'][0][0]
-        self.ad = self.mat_dict['ad'][0][0]
-        self.rings = self.mat_dict['RINGs'][0, :]
-        r = self.rings[0].ring[0, :]
-
-        self.n_at_elements = len(r)
-        self.name_map = NameMap(self.n_at_elements)
+        self.machine = str(self.ad.Maschine[0])
+        self.n_fit_iterations = len(self.rings)
+        # element names do not change between fit iterations, use the last one which is needed most of the time
+        self.ring_tables = {}
+        table = self.get_ring_table(-1)
 
+        self.n_at_elements = len(table)
         print(f'Locofile belongs to: {self.ad.Maschine}')
+        self.name_map = self.build_name_map(table)
+
+        if categorical:
+            self.name_map = self.name_map.to_categorical()
+
+    @metrics.timed('stage_seconds', stage='build_name_map')
+    def build_name_map(self, table):
+        """ NameMap of all AT elements from the ao families, table (RingTable) provides the AT names """
+        name_map = NameMap(len(table))
 
         # loop over AO entries to fill name_map
         for family_name in self.ao._fieldnames:
@@ -108,35 +485,40 @@ class ATRingWithAO:
 
             at_type = family_object.AT[0, 0].ATType[0]
             ao_names = family_object.CommonNames
-            ps_names = family_object.Monitor[0, 0].ChannelNames
+            # channel name up to the first ':' for the whole family at once, before RF repeats it
+            ps_names = np.char.partition(family_object.Monitor[0, 0].ChannelNames.astype(str), ':')[:, 0]
             if family_name == 'RF':
                 ao_names = np.repeat(ao_names, len(at_indices))
                 ps_names = np.repeat(ps_names, len(at_indices))
+
+            # whole family at once, flattened in the same order as MatLab stores it (a later index overwrites)
             n_1st, n_2nd = at_indices.shape
-            for i_2nd in range(n_2nd):
-                for i_1st in range(n_1st):
-                    j = at_indices[i_1st, i_2nd] - 1
-                    self.name_map.at_indices[j] = j  # note: start at zero (python style)
-                    self.name_map.ao_indices[j] = i_1st  # note: start at zero (python style)
-                    self.name_map.at_types[j] = at_type
-                    self.name_map.ao_names[j] = ao_names[i_1st]
-                    self.name_map.ps_names[j] = ps_names[i_1st].split(':')[0]
-
-        # loop over RING to fill additionally with AT ('family') name
-        for i, x in enumerate(r):
-            self.name_map.at_names[i] = x[0, 0].FamName[0]
+            j = at_indices.flatten(order='F').astype(int) - 1
+            i_1st = np.tile(np.arange(n_1st), n_2nd)
+            name_map.at_indices[j] = j  # note: start at zero (python style)
+            name_map.ao_indices[j] = i_1st  # note: start at zero (python style)
+            name_map.at_types[j] = at_type
+            name_map.ao_names[j] = ao_names[i_1st]
+            name_map.ps_names[j] = ps_names[i_1st]
+
+        # fill additionally with AT ('family') name
+        name_map.at_names[:] = table.name
+
+        name_map.invalidate_index()
 
         # some consistency checks
-        for at_name, ps_name in zip(self.name_map.at_names, self.name_map.ps_names):
-            if at_name == 'BEND' and ps_name not in ('PB1ID6R', 'PB2ID6R', 'PB3ID6R', 'BPR', 'BPRP'):
-                raise Exception('ERROR : BROKEN FILE!!! Probable cause: init and AT file incompatible!!!')
+        bend = name_map.at_names == 'BEND'
+        if not np.isin(name_map.ps_names[bend], ('PB1ID6R', 'PB2ID6R', 'PB3ID6R', 'BPR', 'BPRP')).all():
+            raise Exception('ERROR : BROKEN FILE!!! Probable cause: init and AT file incompatible!!!')
+
+        return name_map
 
     def _get_magnet_strength(self, name, strength, at_type):
-        if self.ad.Maschine == 'BESSYII':
+        if self.machine == 'BESSYII':
             quad_length = {'Q1': 0.25, 'Q2': 0.20, 'Q3': 0.25, 'Q4': 0.50, 'Q5': 0.20, 'QI': 0.122}
             sext_length = {'S1': 0.21, 'S2': 0.16, 'S3': 0.16, 'S4': 0.16}
             name = name.replace('PR', '').replace('PD', 'D').replace('PT', 'T').replace('PQ', 'Q').replace('R', '')
-        elif self.ad.Maschine == 'MLS':
+        elif self.machine == 'MLS':
             quad_length = {'Q1': 0.2, 'Q2': 0.2, 'Q3': 0.2}
             sext_length = {'S1': 0.1, 'S2': 0.1, 'S3': 0.1}
             name = name.replace('RP', '')
@@ -153,26 +535,84 @@ class ATRingWithAO:
         else:
             print("Unkown at type!")
 
-    def get_magnet_strength(self, at_type='QUAD', fit_iteration=-1, method='byPowerSupply'):
-        r = self.rings[fit_iteration].ring[0, :]
+    def get_ring_table(self, fit_iteration=-1):
+        """ columnar RingTable of a fit iteration, decoded once and cached """
+        fit_iteration %= self.n_fit_iterations
+        if fit_iteration not in self.ring_tables:
+            with metrics.timer('stage_seconds', stage='ring_table'):
+                self.ring_tables[fit_iteration] = RingTable.from_ring(self.rings[fit_iteration].ring[0, :])
+        return self.ring_tables[fit_iteration]
 
-        get_strength = {'QUAD': lambda i: r[i][0, 0].K[0, 0], 'SEXT': lambda i: r[i][0, 0].PolynomB[0, 2]}[at_type]
+    def _get_ps_groups(self, at_type):
+        """ ps_names, at_indices of all power supplies concatenated, start of each group and group sizes """
+        groups = self.name_map.get_at_indices_grouped('ps_names', at_type=at_type)
+        ps_names = np.array(list(groups), dtype='U40')
+        counts = np.array([len(at_indices) for at_indices in groups.values()], dtype=int)
+        at_indices = np.concatenate(list(groups.values())) if groups else np.zeros(0, dtype=int)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1])) if groups else counts
+        return ps_names, at_indices, starts, counts
 
+    def get_magnet_strength_statistics(self, at_type='QUAD', fit_iteration=-1):
+        """
+        mean, spread (max - min) and mismatch flag of the strengths of all elements of each power supply
+        returns dict of arrays aligned with ps_names
+        """
+        ps_names, at_indices, starts, counts = self._get_ps_groups(at_type)
+        if not len(ps_names):
+            empty = np.zeros(0)
+            return dict(ps_names=ps_names, n_elements=counts, mean=empty, spread=empty, mismatch=empty.astype(bool))
+        values = self.get_ring_table(fit_iteration).get_strengths_of(at_type, at_indices)
+        mean = np.add.reduceat(values, starts) / counts
+        spread = np.maximum.reduceat(values, starts) - np.minimum.reduceat(values, starts)
+        return dict(ps_names=ps_names, n_elements=counts, mean=mean, spread=spread, mismatch=spread != 0)
+
+    def get_fit_trajectory(self, at_types=('QUAD', 'SEXT'), tolerance=1e-6):
+        """
+        strengths of all power supplies for every fit iteration, the name lookups are done once
+        returns dict with
+            ps_names, at_types: power supply axis
+            strengths: n_fit_iterations x n_power_supplies (average over the elements of each power supply)
+            deltas: change from one fit iteration to the next, n_fit_iterations - 1 x n_power_supplies
+            rms_delta, max_delta, max_relative_delta: per fit iteration step
+            converged_iteration: first fit iteration after which no relative change exceeds tolerance (None if never)
+        """
+        groups = [(at_type, self._get_ps_groups(at_type)) for at_type in at_types]
+        ps_names = np.concatenate([group[0] for _, group in groups])
+        ps_types = np.concatenate([np.full(len(group[0]), at_type, dtype='U4') for at_type, group in groups])
+
+        strengths = np.empty((self.n_fit_iterations, len(ps_names)))
+        for fit_iteration in range(self.n_fit_iterations):
+            table = self.get_ring_table(fit_iteration)
+            columns = []
+            for at_type, (names, at_indices, starts, counts) in groups:
+                if len(names):
+                    columns.append(np.add.reduceat(table.get_strengths_of(at_type, at_indices), starts) / counts)
+            strengths[fit_iteration] = np.concatenate(columns) if columns else ()
+
+        deltas = np.diff(strengths, axis=0)
+        reference = np.abs(strengths[:-1])
+        relative_deltas = np.abs(np.divide(deltas, reference, out=deltas.copy(), where=reference > 0))
+        max_relative_delta = relative_deltas.max(axis=1, initial=0)
+        above = np.flatnonzero(max_relative_delta > tolerance)
+        converged_iteration = above[-1] + 1 if len(above) else 0
+        if converged_iteration >= self.n_fit_iterations - 1:  # last step still above tolerance or only one iteration
+            converged_iteration = None
+        return dict(ps_names=ps_names, at_types=ps_types, strengths=strengths, deltas=deltas,
+                    rms_delta=np.sqrt(np.mean(deltas ** 2, axis=1)) if len(ps_names) else np.zeros(len(deltas)),
+                    max_delta=np.abs(deltas).max(axis=1, initial=0), max_relative_delta=max_relative_delta,
+                    converged_iteration=converged_iteration)
+
+    @metrics.timed('stage_seconds', stage='get_magnet_strength')
+    def get_magnet_strength(self, at_type='QUAD', fit_iteration=-1, method='byPowerSupply'):
         if method == 'byPowerSupply':
             print(f'List magnet ({at_type}) strength by power supply.')
-            ps_names = self.name_map.get_ps_names(at_type=at_type)
-            print(f'Number of independent parameters: {len(ps_names)}')
+            statistics = self.get_magnet_strength_statistics(at_type=at_type, fit_iteration=fit_iteration)
+            print(f'Number of independent parameters: {len(statistics["ps_names"])}')
+            for ps_name in statistics['ps_names'][statistics['mismatch']]:
+                print(f'WARNING: Differnt elements of same power supply ({ps_name}) have differnt values!'
+                      'Probably not fitted according to Power supply! Using average value!')
             elements = {}
-            for ps_name in ps_names:
-                at_indices = self.name_map.get_at_indices_by_ps_names(ps_name)
-                strength = get_strength(at_indices[0])
-                average_strength = 0
-                for i in at_indices:
-                    if strength != get_strength(i):  # r[i][0,0].K[0,0]:
-                        print('WARNING: Differnt elements of same power supply have differnt values!'
-                              'Probably not fitted according to Power supply! Using average value!')
-                    average_strength += get_strength(i)
-                average_strength = average_strength / len(at_indices)
+            for ps_name, average_strength in zip(statistics['ps_names'].tolist(), statistics['mean']):
                 elements.update(self._get_magnet_strength(ps_name, average_strength, at_type))
             return elements
         else:
@@ -0,0 +1,201 @@
+# synthetic LOCO files in ATRingWithAO format, to test and benchmark mmltools without machine data
+import argparse
+
+import numpy as np
+import scipy.io as sio
+
+ENERGY = {'BESSYII': 1.7e9, 'MLS': 0.629e9}
+HARMONIC_NUMBER = {'BESSYII': 400, 'MLS': 80}
+QUAD_K = {'BESSYII': {'Q1': 2.44, 'Q2': -1.85, 'Q3': -2.3, 'Q4': 2.4, 'Q5': -2.5},
+          'MLS': {'Q1': 2.0, 'Q2': -2.5, 'Q3': 3.0}}
+SEXT_POLYNOM_B = {'BESSYII': {'S1': 20.0, 'S2': -15.0, 'S3': -25.0, 'S4': 30.0},
+                  'MLS': {'S1': 15.0, 'S2': -20.0, 'S3': 10.0}}
+
+
+def bessy2_sector(i, n_sectors):
+    """
+    one double bend achromat from straight i to straight i + 1 (alternating D and T straights), elements as
+    (FamName, ao family, power supply, length); Q3 to Q5, S2 to S4 are powered per straight like at BESSY II
+    """
+    def straight(j):
+        j %= n_sectors
+        return ('D' if j % 2 == 0 else 'T'), j // 2 + 1
+
+    def half(kind, number):
+        q5 = [('Q5', 'Q5', f'Q5PT{number}R', 0.2), ('DQ5', None, None, 0.233)] if kind == 'T' else []
+        return q5 + [
+            ('S4', 'S4', f'S4P{kind}R', 0.0), ('HCM', 'HCM', f'HS4P{kind}{number}R', 0.0), ('D8', None, None, 0.233),
+            ('Q4', 'Q4', f'Q4P{kind}{number}R', 0.5), ('D7', None, None, 0.233),
+            ('S3', 'S3', f'S3P{kind}R', 0.0), ('VCM', 'VCM', f'VS3P{kind}{number}R', 0.0), ('D6', None, None, 0.143),
+            ('BPM', 'BPM', f'BPM{kind}{number}R', 0.0), ('D6', None, None, 0.09),
+            ('Q3', 'Q3', f'Q3P{kind}{number}R', 0.25), ('D5', None, None, 0.42),
+        ]
+
+    def arc(kind, number):
+        return [
+            ('BEND', 'BEND', 'BPR', 0.4275), ('HCM', 'HCM', f'HBP{kind}{number}R', 0.0), ('BEND', 'BEND', 'BPR', 0.4275),
+            ('D4', None, None, 0.42), ('Q2', 'Q2', 'Q2PDR', 0.2), ('D3', None, None, 0.244),
+            ('BPM', 'BPM', f'BPM{kind}{number}A', 0.0), ('S2', 'S2', f'S2P{kind}R', 0.0),
+            ('VCM', 'VCM', f'VS2P{kind}{number}R', 0.0), ('D2', None, None, 0.368), ('Q1', 'Q1', 'Q1PDR', 0.25),
+        ]
+
+    start, end = straight(i), straight(i + 1)
+    center = [('D1', None, None, 0.265), ('S1', 'S1', 'S1PR', 0.0), ('D1', None, None, 0.265)]
+    straight_drift = [('DSTRAIGHT', None, None, 2.5)]
+    return straight_drift + half(*start) + arc(*start) + center + arc(*end)[::-1] + half(*end)[::-1]
+
+
+def mls_sector(i, n_sectors):
+    """ one sector of the MLS, power supplies named as Q1P1RP """
+    number = i + 1
+    return [
+        ('DSTRAIGHT', None, None, 2.5), ('BPM', 'BPM', f'BPM{number}A', 0.0), ('D1', None, None, 0.2),
+        ('Q1', 'Q1', f'Q1P{number}RP', 0.2), ('D2', None, None, 0.3), ('S1', 'S1', f'S1P{number}RP', 0.0),
+        ('HCM', 'HCM', f'HS1P{number}RP', 0.0), ('D3', None, None, 0.3), ('Q2', 'Q2', f'Q2P{number}RP', 0.2),
+        ('D4', None, None, 0.4), ('BEND', 'BEND', 'BPRP', 0.6), ('BEND', 'BEND', 'BPRP', 0.6),
+        ('D5', None, None, 0.3), ('S2', 'S2', f'S2P{number}RP', 0.0), ('VCM', 'VCM', f'VS2P{number}RP', 0.0),
+        ('D6', None, None, 0.2), ('Q3', 'Q3', f'Q3P{number}RP', 0.2), ('D6', None, None, 0.2),
+        ('S3', 'S3', f'S3P{number}RP', 0.0), ('D5', None, None, 0.3), ('BEND', 'BEND', 'BPRP', 0.6),
+        ('BEND', 'BEND', 'BPRP', 0.6), ('D4', None, None, 0.4), ('BPM', 'BPM', f'BPM{number}B', 0.0),
+    ]
+
+
+SECTORS = {'BESSYII': bessy2_sector, 'MLS': mls_sector}
+AT_TYPES = {'BPM': 'BPM', 'BEND': 'BEND', 'HCM': 'HCM', 'VCM': 'VCM', 'Q1': 'QUAD', 'Q2': 'QUAD', 'Q3': 'QUAD',
+            'Q4': 'QUAD', 'Q5': 'QUAD', 'S1': 'SEXT', 'S2': 'SEXT', 'S3': 'SEXT', 'S4': 'SEXT', 'RF': 'RF Cavity'}
+
+
+def make_lattice(machine='BESSYII', n_sectors=16):
+    """ element list (FamName, ao family, power supply, length) of the whole ring, the RF cavities at the end """
+    elements = [element for i in range(n_sectors) for element in SECTORS[machine](i, n_sectors)]
+    return elements + [('CAV', 'RF', 'MCLKHX251C', 0.0)] * 4
+
+
+def make_element(fam_name, family, length, strength, bending_angle, energy):
+    element = dict(FamName=fam_name, Length=float(length))
+    if family is None or family == 'RF':
+        element['PassMethod'] = 'DriftPass'
+        if family == 'RF':
+            element.update(Voltage=0.5e6, Frequency=499.6e6, PhaseLag=0.0)
+    elif family in ('BPM',):
+        element['PassMethod'] = 'IdentityPass'
+    elif family in ('HCM', 'VCM'):
+        element.update(KickAngle=np.zeros((1, 2)), PassMethod='CorrectorPass')
+    else:
+        polynom_b = np.zeros((1, 4))
+        element.update(MaxOrder=3, NumIntSteps=10, PolynomA=np.zeros((1, 4)))
+        if family == 'BEND':
+            element.update(BendingAngle=bending_angle[0], EntranceAngle=bending_angle[1], ExitAngle=bending_angle[2],
+                           K=0.0, PassMethod='BndMPoleSymplectic4Pass')
+        elif AT_TYPES[family] == 'QUAD':
+            polynom_b[0, 1] = strength
+            element.update(K=strength, PassMethod='StrMPoleSymplectic4Pass')
+        else:
+            polynom_b[0, 2] = strength
+            element['PassMethod'] = 'ThinMPolePass'
+        element['PolynomB'] = polynom_b
+    element['Energy'] = energy
+    return element
+
+
+def make_ao(lattice):
+    """ middle layer families, the member order is the order of the elements, bends have two halves per member """
+    members = {}
+    for i, (fam_name, family, ps_name, length) in enumerate(lattice, 1):
+        if family is not None:
+            members.setdefault(family, []).append((i, ps_name))
+
+    ao = {}
+    for family, entries in members.items():
+        if family in ('BEND', 'RF'):
+            n_columns = 2 if family == 'BEND' else len(entries)
+            at_index = np.array([i for i, _ in entries], dtype=np.uint16).reshape(-1, n_columns)
+            ps_names = [ps_name for _, ps_name in entries[::n_columns]]
+        else:
+            at_index = np.array([[i] for i, _ in entries], dtype=np.uint16)
+            ps_names = [ps_name for _, ps_name in entries]
+        if family == 'RF':
+            at_index = at_index.T  # one member, all cavities
+        n = len(ps_names)
+        ao[family] = dict(
+            FamilyName=family, FamilyType=AT_TYPES[family], MemberOf=np.array([AT_TYPES[family]], dtype=object),
+            Monitor=dict(Mode='Online', DataType='Scalar', Units='Hardware',
+                         ChannelNames=np.array([ps_name + (':hwRdFreq.VAL' if family == 'RF' else ':rdbk')
+                                                for ps_name in ps_names])),
+            Setpoint=dict(ChannelNames=np.array([ps_name + ':set' for ps_name in ps_names])),
+            CommonNames=np.array([f'{family}M{k + 1}' for k in range(n)]),
+            Status=np.ones((n, 1)), DeviceList=np.column_stack((np.arange(n) + 1, np.ones(n))),
+            ElementList=np.arange(1, n + 1).reshape(-1, 1),
+            AT=dict(ATType=AT_TYPES[family], ATIndex=at_index))
+    ao['TUNE'] = dict(FamilyName='TUNE', MemberOf=np.array(['TUNE'], dtype=object), Status=np.ones((2, 1)),
+                      Monitor=dict(ChannelNames=np.array(['TUNEZR:rdH', 'TUNEZR:rdV'])))
+    ao['DCCT'] = dict(FamilyName='DCCT', MemberOf=np.array(['DCCT'], dtype=object), Status=np.ones((1, 1)),
+                      Monitor=dict(ChannelNames=np.array(['CUMZR:rdCur'])))
+    return ao
+
+
+def make_rings(lattice, machine, n_fit_iterations, seed=None):
+    """
+    RINGs struct array, one ring per LOCO fit iteration. Magnets on the same power supply share their strength,
+    the strengths converge to their final values with every fit iteration.
+    """
+    rng = np.random.default_rng(seed)
+    ps_names = sorted({ps_name for _, family, ps_name, _ in lattice if family in QUAD_K[machine] or
+                       family in SEXT_POLYNOM_B[machine]})
+    base = {**QUAD_K[machine], **SEXT_POLYNOM_B[machine]}
+    family_of = {ps_name: family for _, family, ps_name, _ in lattice if family in base}
+    final = {ps_name: base[family_of[ps_name]] * (1 + 0.02 * rng.standard_normal()) for ps_name in ps_names}
+    errors = {ps_name: 0.01 * rng.standard_normal() for ps_name in ps_names}
+
+    n_bends = sum(family == 'BEND' for _, family, _, _ in lattice)
+    angle = 2 * np.pi / n_bends
+    bends = iter(range(n_bends))
+    bending_angles = [(angle, angle, 0.0) if next(bends) % 2 == 0 else (angle, 0.0, angle)
+                      for _, family, _, _ in lattice if family == 'BEND']
+
+    rings = np.empty((1, n_fit_iterations), dtype=[('ring', object)])
+    for iteration in range(n_fit_iterations):
+        decay = 0.5 ** iteration if iteration < n_fit_iterations - 1 else 0.0
+        strengths = {ps_name: value * (1 + errors[ps_name] * decay) for ps_name, value in final.items()}
+        bend = iter(bending_angles)
+        ring = np.empty((1, len(lattice)), dtype=object)
+        for i, (fam_name, family, ps_name, length) in enumerate(lattice):
+            ring[0, i] = make_element(fam_name, family, length, strengths.get(ps_name),
+                                      next(bend) if family == 'BEND' else None, ENERGY[machine])
+        rings[0, iteration] = (ring,)
+    return rings
+
+
+def make_at_ring_with_ao(machine='BESSYII', n_sectors=16, n_fit_iterations=21, seed=None):
+    """ dict of the variables RINGs, ao and ad of a LOCO file """
+    if machine not in SECTORS:
+        raise Exception('Unkown Maschine.')
+    lattice = make_lattice(machine, n_sectors)
+    ad = dict(Maschine=machine, SubMachine='StorageRing', MachineType='StorageRing', OperationalMode='User',
+              HarmonicNumber=HARMONIC_NUMBER[machine], Energy=ENERGY[machine] / 1e9,
+              Circumference=sum(length for *_, length in lattice))
+    return dict(RINGs=make_rings(lattice, machine, n_fit_iterations, seed), ao=make_ao(lattice), ad=ad)
+
+
+def write_at_ring_with_ao(filename, machine='BESSYII', n_sectors=16, n_fit_iterations=21, seed=None,
+                          compress=True):
+    """ writes a MAT-file (v5, compressed like MatLab does) which can be read by mmltools.ATRingWithAO """
+    sio.savemat(filename, make_at_ring_with_ao(machine, n_sectors, n_fit_iterations, seed),
+                do_compression=compress, oned_as='row')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic LOCO file in ATRingWithAO format.')
+    parser.add_argument('filename')
+    parser.add_argument('--machine', default='BESSYII', choices=sorted(SECTORS))
+    parser.add_argument('--sectors', type=int, default=16, help='number of achromats, scales the number of elements')
+    parser.add_argument('--fit-iterations', type=int, default=21)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--no-compression', action='store_true')
+    args = parser.parse_args(args)
+    write_at_ring_with_ao(args.filename, args.machine, args.sectors, args.fit_iterations, args.seed,
+                          not args.no_compression)
+
+
+if __name__ == '__main__':
+    main()
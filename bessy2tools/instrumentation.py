@@ -0,0 +1,267 @@
+# timers, latency histograms and counters for PV I/O and processing stages
+"""
+everything is recorded in the module-level Metrics object metrics, which is disabled by default: a disabled timer is
+a shared no-op context manager and instrumented loops check metrics.enabled once, so the cost is an attribute lookup.
+
+enable it in a script with metrics.enable(path) or for any script by the environment variable BESSY2TOOLS_METRICS:
+    BESSY2TOOLS_METRICS=1                    summary on exit only
+    BESSY2TOOLS_METRICS=metrics.prom         Prometheus text file (node exporter textfile collector) and summary
+    BESSY2TOOLS_METRICS=metrics.jsonl        one JSON line per metric and label set, appended on every export
+BESSY2TOOLS_METRICS_INTERVAL=60 exports every 60 s in addition to the export on exit.
+
+usage:
+    with metrics.timer('pv_get_seconds', pv=pvname):
+        ...
+
+    @metrics.timed('stage_seconds', stage='loadmat')
+    def load(...):
+
+    metrics.count('pv_timeouts', pv=pvname, operation='get')
+"""
+import atexit
+import bisect
+import contextlib
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+# upper bounds in seconds, from a fast local read to a slow magnet ramp
+BUCKETS = (1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PREFIX = 'bessy2tools_'
+NULL_TIMER = contextlib.nullcontext()
+
+
+class Histogram:
+    """ counts of observations per bucket, the last bucket takes everything above BUCKETS[-1] """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """ q-quantile interpolated linearly within its bucket like Prometheus does, within min and max """
+        if not self.count:
+            return math.nan
+        rank = q * self.count
+        total = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets + (self.max,), self.counts):
+            if count and total + count >= rank:
+                value = lower + (upper - lower) * (rank - total) / count
+                return min(max(value, self.min), self.max)
+            total += count
+            lower = upper
+        return self.max
+
+
+class Timer:
+    """ observes the seconds spent in the with block, also if it is left by an exception """
+
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.histograms = {}  # (name, labels) -> Histogram, labels is a sorted tuple of (key, value)
+        self.counters = {}  # (name, labels) -> int
+        self.path = None
+        self.summary_on_exit = True
+        self.export_thread = None
+        self.registered = False
+
+    def enable(self, path=None, summary=True, export_interval=None):
+        """ start recording, export to path (.prom: Prometheus text, else JSON lines) and print a summary on exit """
+        self.enabled = True
+        self.path = path
+        self.summary_on_exit = summary
+        if not self.registered:
+            atexit.register(self.on_exit)
+            self.registered = True
+        if export_interval and path and self.export_thread is None:
+            self.export_thread = threading.Thread(target=self.run_export, args=(export_interval,), daemon=True)
+            self.export_thread.start()
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, n=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels) if self.enabled else NULL_TIMER
+
+    def timed(self, name, **labels):
+        """ decorator, times every call of the function while enabled """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with Timer(self, name, labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        with self.lock:
+            histograms = {}
+            for key, histogram in self.histograms.items():
+                histograms[key] = copy = Histogram(histogram.buckets)
+                copy.merge(histogram)
+            return histograms, dict(self.counters)
+
+    def to_prometheus(self):
+        histograms, counters = self.snapshot()
+        lines = []
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f'# TYPE {PREFIX}{name} histogram')
+            for (series, labels), histogram in sorted(histograms.items()):
+                if series != name:
+                    continue
+                total = 0
+                for upper, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    total += count
+                    lines.append(f'{PREFIX}{name}_bucket{format_labels(labels + (("le", upper),))} {total}')
+                lines.append(f'{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum!r}')
+                lines.append(f'{PREFIX}{name}_count{format_labels(labels)} {histogram.count}')
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f'# TYPE {PREFIX}{name}_total counter')
+            for (series, labels), value in sorted(counters.items()):
+                if series == name:
+                    lines.append(f'{PREFIX}{name}_total{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def to_records(self):
+        histograms, counters = self.snapshot()
+        now = time.time()
+        records = []
+        for (name, labels), histogram in sorted(histograms.items()):
+            records.append(dict(time=now, type='histogram', name=name, labels=dict(labels), count=histogram.count,
+                                sum=histogram.sum, min=histogram.min, max=histogram.max,
+                                p50=histogram.quantile(0.5), p95=histogram.quantile(0.95),
+                                buckets=dict(zip(map(str, histogram.buckets + ('+Inf',)), histogram.counts))))
+        for (name, labels), value in sorted(counters.items()):
+            records.append(dict(time=now, type='counter', name=name, labels=dict(labels), value=value))
+        return records
+
+    def export(self, path=None):
+        """ Prometheus text files are replaced atomically so that a collector never reads half a file """
+        path = path or self.path
+        if path.endswith('.prom'):
+            with open(path + '.tmp', 'w') as file:
+                file.write(self.to_prometheus())
+            os.replace(path + '.tmp', path)
+        else:
+            with open(path, 'a') as file:
+                for record in self.to_records():
+                    file.write(json.dumps(record) + '\n')
+
+    def run_export(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.export()
+            except OSError as error:
+                print(f'Could not export metrics to {self.path}: {error}')
+
+    def summary(self, n_slowest=5):
+        """ table of every timed operation over all its labels, with the slowest label sets by p95, and the counters """
+        histograms, counters = self.snapshot()
+        lines = [f'{"operation":36} {"calls":>8} {"mean / ms":>10} {"p50 / ms":>10} {"p95 / ms":>10} {"max / ms":>10}']
+        for name in sorted({name for name, _ in histograms}):
+            series = [(labels, histogram) for (series, labels), histogram in histograms.items() if series == name]
+            total = Histogram()
+            for _, histogram in series:
+                total.merge(histogram)
+            rows = [(name, total)]
+            if len(series) > 1:
+                slowest = sorted(series, key=lambda item: item[1].quantile(0.95), reverse=True)[:n_slowest]
+                rows += [('  ' + ' '.join(str(value) for _, value in labels), histogram) for labels, histogram in slowest]
+            elif series[0][0]:
+                rows = [(f'{name} {" ".join(str(value) for _, value in series[0][0])}', total)]
+            for label, histogram in rows:
+                lines.append(f'{label:36} {histogram.count:8} {1e3 * histogram.sum / histogram.count:10.3f} '
+                             f'{1e3 * histogram.quantile(0.5):10.3f} {1e3 * histogram.quantile(0.95):10.3f} '
+                             f'{1e3 * histogram.max:10.3f}')
+        for (name, labels), value in sorted(counters.items()):
+            label = ' '.join([name] + [str(value) for _, value in labels])
+            lines.append(f'{label:36} {value:8}')
+        return '\n'.join(lines)
+
+    def on_exit(self):
+        if not self.enabled:
+            return
+        if self.path:
+            self.export()
+        if self.summary_on_exit:
+            print(self.summary())
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+metrics = Metrics()
+
+if os.environ.get('BESSY2TOOLS_METRICS'):
+    setting = os.environ['BESSY2TOOLS_METRICS']
+    metrics.enable(None if setting.lower() in ('1', 'true', 'yes') else setting,
+                   export_interval=float(os.environ.get('BESSY2TOOLS_METRICS_INTERVAL', 0)) or None)
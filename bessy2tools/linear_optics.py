@@ -0,0 +1,250 @@
+# vectorized linear optics (uncoupled, hard-edge) to screen many quadrupole settings at once
+import argparse
+import json
+import time
+
+import numpy as np
+
+TWO_PI = 2 * np.pi
+
+
+class Lattice:
+    """
+    flat sequence of elements as arrays: length, k1, bending angle, entrance and exit angle (e1, e2)
+    sextupoles and all other elements without k1 or angle are drifts in linear optics
+    """
+
+    def __init__(self, names, length, k1, angle, e1, e2):
+        self.names = np.asarray(names)
+        self.length = np.asarray(length, dtype=float)
+        self.k1 = np.asarray(k1, dtype=float)
+        self.angle = np.asarray(angle, dtype=float)
+        self.e1 = np.asarray(e1, dtype=float)
+        self.e2 = np.asarray(e2, dtype=float)
+        self.s = np.cumsum(self.length)
+
+    def __len__(self):
+        return len(self.length)
+
+    @classmethod
+    def from_json(cls, lattice):
+        """ lattice file (path or dict) with elements, cells and main_cell as used by quad_conversion """
+        if isinstance(lattice, str):
+            with open(lattice) as file:
+                lattice = json.load(file)
+        elements, cells = lattice['elements'], lattice.get('cells', {})
+
+        def flatten(names):
+            for name in names:
+                if name in cells:
+                    yield from flatten(cells[name])
+                else:
+                    yield name
+
+        names = list(flatten(lattice['main_cell']))
+        attributes = [elements[name] for name in names]
+        return cls(names, *([attribute.get(key, 0.0) for attribute in attributes]
+                            for key in ('length', 'k1', 'angle', 'e1', 'e2')))
+
+    @classmethod
+    def from_ring_table(cls, table):
+        """ mmltools.RingTable of an ATRingWithAO fit iteration """
+        def get(column):
+            return np.where(table.valid[column], getattr(table, column), 0.0)
+        return cls(table.name, table.length, get('K'), get('bending_angle'), get('entrance_angle'), get('exit_angle'))
+
+    def get_indices(self, name):
+        return np.flatnonzero(self.names == name)
+
+
+def get_matrices(k, length):
+    """ 2x2 transfer matrices of thick elements with focusing strength k (1/m^2), any shape """
+    k, length = np.broadcast_arrays(np.asarray(k, dtype=float), np.asarray(length, dtype=float))
+    sqrt_k = np.sqrt(np.abs(k))
+    phi = sqrt_k * length
+    focusing, defocusing = k > 0, k < 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = np.where(focusing, np.cos(phi), np.where(defocusing, np.cosh(phi), 1.0))
+        s = np.where(focusing, np.sin(phi) / sqrt_k, np.where(defocusing, np.sinh(phi) / sqrt_k, length))
+        s_prime = np.where(focusing, -sqrt_k * np.sin(phi), np.where(defocusing, sqrt_k * np.sinh(phi), 0.0))
+    matrices = np.empty(k.shape + (2, 2))
+    matrices[..., 0, 0] = matrices[..., 1, 1] = c
+    matrices[..., 0, 1] = s
+    matrices[..., 1, 0] = s_prime
+    return matrices
+
+
+def get_element_matrices(k1, length, angle, e1, e2):
+    """ (..., 2 planes, n_elements, 2, 2) matrices, k1 may carry leading batch dimensions """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = np.where(length > 0, angle / length, 0.0)
+    k1 = np.asarray(k1, dtype=float)
+    matrices = np.stack((get_matrices(k1 + h ** 2, length), get_matrices(-k1, length)), axis=-4)
+    bend = angle != 0
+    if bend.any():
+        # hard-edge focusing of the pole faces: horizontal h tan(e), vertical -h tan(e)
+        for edge, first in ((e1, True), (e2, False)):
+            kick = h[bend] * np.tan(edge[bend])
+            edges = np.zeros((2, bend.sum(), 2, 2))
+            edges[..., 0, 0] = edges[..., 1, 1] = 1
+            edges[0, :, 1, 0], edges[1, :, 1, 0] = kick, -kick
+            sub = matrices[..., bend, :, :]
+            matrices[..., bend, :, :] = sub @ edges if first else edges @ sub
+    return matrices
+
+
+def multiply(matrices):
+    """ product M_n-1 ... M_1 M_0 over the element axis (-3) as a tree of stacked matrix products """
+    while matrices.shape[-3] > 1:
+        if matrices.shape[-3] % 2:
+            matrices = np.concatenate((matrices, np.broadcast_to(np.eye(2), matrices[..., :1, :, :].shape)), axis=-3)
+        matrices = matrices[..., 1::2, :, :] @ matrices[..., 0::2, :, :]
+    return matrices[..., 0, :, :]
+
+
+def accumulate(matrices):
+    """ all partial products M_i ... M_0 along the element axis (-3), log2(n) stacked matrix products """
+    cumulative = matrices.copy()
+    step = 1
+    while step < cumulative.shape[-3]:
+        cumulative[..., step:, :, :] = cumulative[..., step:, :, :] @ cumulative[..., :-step, :, :]
+        step *= 2
+    return cumulative
+
+
+def get_periodic(one_turn):
+    """ cos(mu), beta and alpha at the start from one-turn matrices (..., 2, 2), NaN if unstable """
+    cos_mu = (one_turn[..., 0, 0] + one_turn[..., 1, 1]) / 2
+    stable = np.abs(cos_mu) < 1
+    with np.errstate(invalid='ignore'):
+        sin_mu = np.sign(one_turn[..., 0, 1]) * np.sqrt(1 - cos_mu ** 2)
+        beta = np.where(stable, one_turn[..., 0, 1] / sin_mu, np.nan)
+        alpha = np.where(stable, (one_turn[..., 0, 0] - one_turn[..., 1, 1]) / (2 * sin_mu), np.nan)
+    return cos_mu, beta, alpha, stable
+
+
+class LinearOptics:
+    """
+    tunes and beta functions of a lattice for a batch of k1 vectors at once.
+    knobs: element names (all elements of a name change together) or dict knob name -> element indices,
+    e.g. the power supplies of mmltools.NameMap.get_at_indices_grouped().
+    The matrices of all elements between knobs do not depend on the knobs and are multiplied once.
+    """
+
+    def __init__(self, lattice, knobs, chunk_size=256):
+        self.lattice = lattice
+        if not isinstance(knobs, dict):
+            knobs = {name: lattice.get_indices(name) for name in knobs}
+        self.knobs = list(knobs)
+        self.knob_of_element = np.full(len(lattice), -1)
+        for i, indices in enumerate(knobs.values()):
+            if len(indices) == 0:
+                raise Exception(f'Knob {self.knobs[i]} has no elements')
+            self.knob_of_element[indices] = i
+        self.chunk_size = chunk_size
+        self.matrices = get_element_matrices(lattice.k1, lattice.length, lattice.angle, lattice.e1, lattice.e2)
+
+        # fixed segments between the knob elements, one matrix each: segment i lies before the i-th knob element
+        self.variable = np.flatnonzero(self.knob_of_element >= 0)
+        bounds = np.concatenate(([0], self.variable + 1))
+        ends = np.concatenate((self.variable, [len(lattice)]))
+        self.segments = np.stack([multiply(self.matrices[:, start:end]) if end > start else np.broadcast_to(
+            np.eye(2), (2, 2, 2)) for start, end in zip(bounds, ends)], axis=1)
+
+        self.reference_tunes = None
+        self.reference_tunes = self.compute(self.get_k1())['tunes'][0]
+
+    def get_k1(self):
+        """ current k1 of every knob (of its first element) """
+        return np.array([self.lattice.k1[np.flatnonzero(self.knob_of_element == i)[0]] for i in range(len(self.knobs))])
+
+    def get_variable_matrices(self, k1):
+        """ (batch, 2, n_variable, 2, 2) matrices of the knob elements for k1 (batch x n_knobs) """
+        lattice, indices = self.lattice, self.variable
+        k1_elements = k1[:, self.knob_of_element[indices]]
+        return get_element_matrices(k1_elements, lattice.length[indices], lattice.angle[indices],
+                                    lattice.e1[indices], lattice.e2[indices])
+
+    def get_one_turn(self, k1):
+        """ one-turn matrices (batch, 2 planes, 2, 2) """
+        variable = self.get_variable_matrices(k1)
+        batch = len(k1)
+        n_segments = self.segments.shape[1]
+        sequence = np.empty((batch, 2, n_segments + variable.shape[2], 2, 2))
+        sequence[:, :, 0::2] = self.segments
+        sequence[:, :, 1::2] = variable
+        return multiply(sequence)
+
+    def get_tunes(self, k1):
+        """
+        tunes (batch x 2) from one-turn matrices only, the fastest way to screen candidates: the integer part is taken
+        as the one closest to the tunes of the lattice the knobs started from, NaN if the optics is unstable
+        """
+        k1 = np.atleast_2d(np.asarray(k1, dtype=float))
+        tunes = np.empty((len(k1), 2))
+        for start in range(0, len(k1), self.chunk_size):
+            one_turn = self.get_one_turn(k1[start:start + self.chunk_size])
+            cos_mu, _, _, stable = get_periodic(one_turn)
+            mu = np.arccos(np.clip(cos_mu, -1, 1))
+            fraction = np.where(one_turn[..., 0, 1] >= 0, mu, TWO_PI - mu) / TWO_PI
+            tunes[start:start + len(one_turn)] = np.where(stable, fraction, np.nan)
+        return tunes if self.reference_tunes is None else tunes + np.round(self.reference_tunes - tunes)
+
+    def compute(self, k1):
+        """
+        dict with tunes (batch x 2), beta_x, beta_y (batch x n_elements + 1, at the start and every element exit),
+        s (n_elements + 1) and stable (batch): the full optics, the phase advance is accumulated element by element
+        """
+        k1 = np.atleast_2d(np.asarray(k1, dtype=float))
+        n = len(self.lattice)
+        tunes = np.empty((len(k1), 2))
+        beta = np.empty((len(k1), 2, n + 1))
+        stable = np.empty(len(k1), dtype=bool)
+        for start in range(0, len(k1), self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            matrices = np.broadcast_to(self.matrices, (len(k1[chunk]),) + self.matrices.shape).copy()
+            matrices[:, :, self.variable] = self.get_variable_matrices(k1[chunk])
+            cumulative = accumulate(matrices)
+            _, beta_0, alpha_0, is_stable = get_periodic(cumulative[:, :, -1])
+            beta_0, alpha_0 = beta_0[..., np.newaxis], alpha_0[..., np.newaxis]
+            c, s = cumulative[..., 0, 0], cumulative[..., 0, 1]
+            beta[chunk, :, 0] = beta_0[..., 0]
+            beta[chunk, :, 1:] = ((c * beta_0 - s * alpha_0) ** 2 + s ** 2) / beta_0
+            phase = np.unwrap(np.arctan2(s, c * beta_0 - s * alpha_0), axis=-1)
+            phase = np.where(phase[..., :1] < 0, phase + TWO_PI, phase)  # first element: 0 <= phase advance < 2 pi
+            tunes[chunk] = np.where(is_stable.all(axis=1)[:, np.newaxis], phase[..., -1] / TWO_PI, np.nan)
+            stable[chunk] = is_stable.all(axis=1)
+        return dict(tunes=tunes, beta_x=beta[:, 0], beta_y=beta[:, 1], s=np.concatenate(([0], self.lattice.s)),
+                    stable=stable)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Tunes of a lattice file and screening rate of random quad settings.')
+    parser.add_argument('lattice', help='lattice file (json)')
+    parser.add_argument('--knobs', nargs='+', help='element names to vary, default: all quadrupoles')
+    parser.add_argument('--candidates', type=int, default=10000, help='random k1 settings to screen')
+    parser.add_argument('--spread', type=float, default=1e-3, help='relative spread of the random k1 settings')
+    args = parser.parse_args(args)
+
+    with open(args.lattice) as file:
+        json_dict = json.load(file)
+    lattice = Lattice.from_json(json_dict)
+    knobs = args.knobs or [name for name, attributes in json_dict['elements'].items()
+                           if attributes['type'] == 'Quad' and name in lattice.names]
+    optics = LinearOptics(lattice, knobs)
+    k1 = optics.get_k1()
+    result = optics.compute(k1)
+    print(f'{len(lattice)} elements, {len(knobs)} knobs, length {lattice.s[-1]:.3f} m')
+    print(f'tunes {result["tunes"][0, 0]:.5f} {result["tunes"][0, 1]:.5f}, '
+          f'max beta {np.nanmax(result["beta_x"]):.2f} {np.nanmax(result["beta_y"]):.2f} m')
+
+    candidates = k1 * (1 + args.spread * np.random.default_rng(0).standard_normal((args.candidates, len(k1))))
+    start = time.perf_counter()
+    tunes = optics.get_tunes(candidates)
+    seconds = time.perf_counter() - start
+    print(f'screened {len(candidates)} candidates in {seconds:.3f} s ({len(candidates) / seconds:.0f} per second), '
+          f'tune spread {np.nanstd(tunes[:, 0]):.5f} {np.nanstd(tunes[:, 1]):.5f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# benchmarks of the PV-driven tools against the virtual BESSY II, to be run before a shift
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from bessy2tools.machine.optimizer import RCDS, AveragedObjective
+from bessy2tools.machine.pv_access import PVGroup, MonitorCache, SetpointWriter, SampleCollector
+from bessy2tools.machine.settle import Settle
+from bessy2tools.machine.simulation import VirtualBessy, SEXTUPOLES, LIFETIME
+from bessy2tools.quad_conversion.name_conversion import quad_list_epics
+
+# name -> True if larger is better
+METRICS = {
+    'read_all_ms': False,
+    'refresh_latency_ms': False,
+    'refresh_latency_p95_ms': False,
+    'set_all_s': False,
+    'set_all_setpoints_per_s': True,
+    'optimizer_evaluations_per_min': True,
+}
+
+
+def benchmark_refresh(backend, repeat):
+    """ batched read of all quad setpoints and time from a write until the monitors show all new values """
+    group = PVGroup([magnet + ':set' for magnet in quad_list_epics], backend)
+    monitor = MonitorCache(group.pvnames, backend)
+    read_times, latencies = [], []
+    for i in range(repeat):
+        start = time.perf_counter()
+        values = group.get_all()
+        read_times.append(time.perf_counter() - start)
+
+        monitor.pop_changed()
+        start = time.perf_counter()
+        backend.put_many(group.pvnames, [value + 0.001 for value in values.values()])
+        seen = set()
+        while len(seen) < len(group.pvnames):
+            seen.update(monitor.pop_changed())
+            time.sleep(0.0005)
+        latencies.append(time.perf_counter() - start)
+    return dict(read_all_ms=1e3 * np.mean(read_times), refresh_latency_ms=1e3 * np.mean(latencies),
+                refresh_latency_p95_ms=1e3 * np.percentile(latencies, 95))
+
+
+def benchmark_set_all(backend, repeat):
+    """ writing all quad setpoints including the readback check """
+    pvnames = [magnet + ':set' for magnet in quad_list_epics]
+    writer = SetpointWriter(backend, timeout=30.0)
+    values = dict(zip(pvnames, backend.get_many(pvnames)))
+    times = []
+    for i in range(repeat):
+        values = {pvname: value + 0.1 * (-1) ** i for pvname, value in values.items()}
+        start = time.perf_counter()
+        writer.write(values)
+        times.append(time.perf_counter() - start)
+    return dict(set_all_s=np.mean(times), set_all_setpoints_per_s=len(pvnames) / np.mean(times))
+
+
+def benchmark_optimizer(backend, n_evaluations):
+    """ tune_optimizer.py setup: RCDS on the sextupoles, settle and averaged lifetime reads """
+    pvnames = [sextupole + ':set' for sextupole in SEXTUPOLES]
+    initial = np.array(backend.get_many(pvnames), dtype=float)
+    bounds = [sorted((value * (1 - 0.0005), value * (1 + 0.0005))) for value in initial]
+    settle = Settle({LIFETIME: 0.05}, backend=backend, window=0.1, timeout=2.0,
+                    tolerance={pvname: 0.1 * (upper - lower) for pvname, (lower, upper) in zip(pvnames, bounds)})
+
+    def apply(values):
+        backend.put_many(pvnames, list(values))
+        settle.wait(dict(zip(pvnames, values)))
+
+    lifetime_updates = SampleCollector([LIFETIME], backend)
+    fitness = AveragedObjective(apply, lambda: -lifetime_updates.collect(1, timeout=1.0)[LIFETIME][0],
+                                min_samples=3, max_samples=5, sem_target=0.05)
+    f0, noise = fitness.estimate_noise(initial)
+    optimizer = RCDS(fitness, bounds, noise=noise, max_evaluations=n_evaluations)
+    start = time.perf_counter()
+    optimizer.run(initial, f0=f0)
+    return dict(optimizer_evaluations_per_min=60 * optimizer.n_evaluations / (time.perf_counter() - start))
+
+
+def compare(results, baseline, max_slowdown):
+    """ metrics that got worse than the baseline by more than the factor max_slowdown """
+    regressions = []
+    for name, larger_is_better in METRICS.items():
+        if name not in results or name not in baseline:
+            continue
+        ratio = baseline[name] / results[name] if larger_is_better else results[name] / baseline[name]
+        if ratio > max_slowdown:
+            regressions.append(f'{name}: {results[name]:.3f} (baseline {baseline[name]:.3f})')
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the PV access against the virtual BESSY II.')
+    parser.add_argument('--latency', type=float, default=0.002, help='s per read or write')
+    parser.add_argument('--ramp-rate', type=float, default=50.0, help='power supply units per second')
+    parser.add_argument('--noise', type=float, default=0.002, help='relative noise of the signals')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--evaluations', type=int, default=30, help='optimizer budget, 0 to skip')
+    parser.add_argument('-o', '--output', help='write the results to a json file, e.g. as the next baseline')
+    parser.add_argument('--baseline', help='json file of an earlier run, exit with 1 on regressions')
+    parser.add_argument('--max-slowdown', type=float, default=1.2)
+    args = parser.parse_args(args)
+
+    backend = VirtualBessy(latency=args.latency, ramp_rate=args.ramp_rate, noise=args.noise, seed=0)
+    results = dict(latency=args.latency, ramp_rate=args.ramp_rate, noise=args.noise)
+    results.update(benchmark_refresh(backend, args.repeat))
+    results.update(benchmark_set_all(backend, max(1, args.repeat // 4)))
+    if args.evaluations:
+        results.update(benchmark_optimizer(backend, args.evaluations))
+    backend.stop()
+
+    for name in METRICS:
+        if name in results:
+            print(f'{name:32} {results[name]:10.3f}')
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.max_slowdown)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+# append-only log of machine evaluations, to resume interrupted optimizations and to warm-start new ones
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+import numpy as np
+
+
+class Points:
+    """ knob values and session codes of all evaluations with the same number of knobs, grown by doubling """
+
+    def __init__(self, n_knobs):
+        self.x = np.empty((16, n_knobs))
+        self.codes = np.empty(16, dtype=int)
+        self.evaluations = []
+
+    def append(self, evaluation, code):
+        n = len(self.evaluations)
+        if n == len(self.x):
+            self.x = np.concatenate((self.x, np.empty_like(self.x)))
+            self.codes = np.concatenate((self.codes, np.empty_like(self.codes)))
+        self.x[n] = evaluation['x']
+        self.codes[n] = code
+        self.evaluations.append(evaluation)
+
+
+class EvaluationLog:
+    """
+    append-only JSON Lines file of session and evaluation records, written by a background thread so that the
+    optimizer never waits for the disk. records that queue up while a batch is written are written together and made
+    durable with a single fsync, a crash loses at most the batch in flight. an incomplete last line left by an
+    interrupted write is dropped when the file is opened.
+    lookup only returns evaluations of the sessions in reuse: the current one, plus all earlier ones for a warm start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sessions = {}
+        self.evaluations = []
+        self.session = None
+        self.reuse = set()
+        self.codes = {}  # session -> int code used in Points
+        self.points = {}  # number of knobs -> Points
+        self.read()
+        self.file = open(path, 'a')
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as file:
+            data = file.read()
+            if data and not data.endswith(b'\n'):
+                file.truncate(data.rfind(b'\n') + 1)
+                data = data[:data.rfind(b'\n') + 1]
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print(f'skip corrupt line in {self.path}: {line[:80]}')
+                continue
+            self.add(record)
+
+    def add(self, record):
+        """ later session records update the earlier ones of the same session """
+        if record.get('type') == 'session':
+            self.sessions.setdefault(record['session'], {}).update(record)
+        else:
+            self.evaluations.append(record)
+            n_knobs = len(record['x'])
+            if n_knobs not in self.points:
+                self.points[n_knobs] = Points(n_knobs)
+            self.points[n_knobs].append(record, self.codes.setdefault(record['session'], len(self.codes)))
+
+    def write(self, record):
+        self.add(record)
+        self.queue.put(record)
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in records
+            lines = [json.dumps(record) + '\n' for record in records if record is not None]
+            if lines:
+                self.file.writelines(lines)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            if stop:
+                return
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+    def start_session(self, initial, bounds, start=None, warm_start=False, **fields):
+        """
+        new session with the initial knob values, bounds and the point the optimizer starts from
+        warm_start: evaluations of all earlier sessions may be reused, otherwise only those of this session
+        """
+        self.session = f'{time.strftime("%Y-%m-%dT%H:%M:%S")}-{uuid.uuid4().hex[:8]}'
+        self.reuse = set(self.sessions) if warm_start else set()
+        self.reuse.add(self.session)
+        start = initial if start is None else start
+        self.write(dict(type='session', session=self.session, time=time.time(), initial=list(map(float, initial)),
+                        bounds=[list(map(float, bound)) for bound in bounds], start=list(map(float, start)), **fields))
+        return self.sessions[self.session]
+
+    def update_session(self, **fields):
+        """ adds fields to the record of the current session, e.g. results which are known only later """
+        self.write(dict(type='session', session=self.session, **fields))
+
+    def resume_session(self, session=None):
+        """ continues the given or the latest session, returns its record """
+        if not self.sessions:
+            raise Exception(f'no session to resume in {self.path}')
+        self.session = session if session is not None else max(self.sessions, key=lambda s: self.sessions[s]['time'])
+        self.reuse = {self.session}
+        n_evaluations = sum(evaluation['session'] == self.session for evaluation in self.evaluations)
+        print(f'resume session {self.session} with {n_evaluations} evaluations')
+        return self.sessions[self.session]
+
+    def append(self, x, value, **fields):
+        self.write(dict(type='evaluation', session=self.session, time=time.time(), x=list(map(float, x)),
+                        value=float(value), **fields))
+
+    def lookup(self, x, tolerance=0.0):
+        """
+        the evaluation of the sessions in reuse closest to x if every knob is within tolerance (number or array),
+        evaluations of the current session take precedence over those of earlier sessions
+        """
+        x = np.asarray(x, dtype=float)
+        points = self.points.get(len(x))
+        if points is None:
+            return None
+        n = len(points.evaluations)
+        distance = np.abs(points.x[:n] - x)
+        within = np.all(distance <= tolerance, axis=1)
+        for sessions in ([self.session], self.reuse):
+            codes = [self.codes[session] for session in sessions if session in self.codes]
+            candidates = np.flatnonzero(within & np.isin(points.codes[:n], codes))
+            if len(candidates):
+                return points.evaluations[candidates[np.argmin(np.max(distance[candidates], axis=1))]]
+        return None
+
+    def best(self, bounds=None):
+        """ the evaluation with the lowest value of all sessions, within bounds if given """
+        evaluations = self.evaluations
+        if bounds is not None:
+            lower, upper = np.array(bounds, dtype=float).T
+            evaluations = [evaluation for evaluation in evaluations if len(evaluation['x']) == len(lower)
+                           and np.all((lower <= evaluation['x']) & (evaluation['x'] <= upper))]
+        return min(evaluations, key=lambda evaluation: evaluation['value'], default=None)
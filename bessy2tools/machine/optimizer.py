@@ -0,0 +1,212 @@
+# optimization of expensive, noisy machine objectives
+import time
+
+import numpy as np
+
+from bessy2tools.instrumentation import metrics
+
+
+class AveragedObjective:
+    """
+    Machine objective: apply(x) sets the knobs once, measure() reads one noisy sample of the objective.
+    Every call of measure() has to return a new reading, e.g. the next monitor update (SampleCollector): polling a PV
+    faster than it updates repeats readings and fakes a standard error of zero.
+    Samples are averaged, at least min_samples, then more until the standard error of the mean is below sem_target
+    (if given) or max_samples is reached. Every evaluation is kept in history.
+    log: EvaluationLog every evaluation is appended to, together with the dict returned by readings() if given.
+    With a tolerance (number or array in knob units), points already in the log within tolerance are not measured
+    again, their logged value is returned instead.
+    """
+
+    def __init__(self, apply, measure, min_samples=3, max_samples=10, sem_target=None, sample_interval=0.0,
+                 log=None, tolerance=None, readings=None):
+        self.apply = apply
+        self.measure = measure
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.sem_target = sem_target
+        self.sample_interval = sample_interval
+        self.log = log
+        self.tolerance = tolerance
+        self.readings = readings
+        self.history = []
+        self.n_reused = 0
+
+    def __call__(self, x):
+        if self.log is not None and self.tolerance is not None:
+            evaluation = self.log.lookup(x, self.tolerance)
+            if evaluation is not None:
+                self.n_reused += 1
+                metrics.count('objective_reused')
+                sem = evaluation['sem'] if evaluation.get('sem') is not None else np.inf
+                self.history.append(dict(x=np.array(x, dtype=float), value=evaluation['value'], sem=sem,
+                                         n_samples=evaluation.get('n_samples'), reused=True))
+                return evaluation['value']
+        return self.measure_at(x)
+
+    def measure_at(self, x):
+        """ applies x and averages new samples, never taken from the log """
+        with metrics.timer('objective_seconds', step='apply'):
+            self.apply(x)
+        samples = []
+        while True:
+            with metrics.timer('objective_seconds', step='measure'):
+                samples.append(self.measure())
+            n = len(samples)
+            sem = np.std(samples, ddof=1) / np.sqrt(n) if n > 1 else np.inf
+            if n >= self.max_samples or (n >= self.min_samples and (self.sem_target is None or sem <= self.sem_target)):
+                break
+            time.sleep(self.sample_interval)
+        value = float(np.mean(samples))
+        self.history.append(dict(x=np.array(x, dtype=float), value=value, sem=float(sem), n_samples=n))
+        if self.log is not None:
+            readings = self.readings() if self.readings is not None else {}
+            self.log.append(x, value, sem=float(sem) if np.isfinite(sem) else None, n_samples=n,
+                            samples=list(map(float, samples)), **readings)
+        return value
+
+    def estimate_noise(self, x, n_repeats=3):
+        """
+        measures x n_repeats times, returns the mean and the standard deviation of the averaged values: the noise of
+        one evaluation as the optimizer sees it, including drifts the standard error of a single evaluation misses
+        """
+        values = [self.measure_at(x) for _ in range(n_repeats)]
+        noise = float(np.std(values, ddof=1)) if n_repeats > 1 else 0.0
+        return float(np.mean(values)), max(noise, self.noise)
+
+    @property
+    def noise(self):
+        """ median standard error of the evaluations so far, the noise level seen by the optimizer """
+        sems = [evaluation['sem'] for evaluation in self.history if np.isfinite(evaluation['sem'])]
+        return float(np.median(sems)) if sems else 0.0
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+class RCDS:
+    """
+    Robust conjugate direction search (X. Huang, Beam-based correction and optimization for accelerators, 2019):
+    Powell's method with a bracketing and parabola-fit line scan that tolerates noise.
+    The knobs are normalized to the unit cube of bounds, points outside the bounds are never evaluated.
+    noise: standard deviation of the objective, used as threshold when bracketing (3 sigma)
+    The result is the point of the last line scan, a parabola fit over all its samples where possible, never just the
+    luckiest single evaluation.
+    """
+
+    def __init__(self, func, bounds, noise=0.0, step=0.1, tolerance=1e-4, max_evaluations=500, n_points=6):
+        self.func = func
+        self.lower, self.upper = np.array(bounds, dtype=float).T
+        self.noise = noise
+        self.step = step
+        self.tolerance = tolerance
+        self.max_evaluations = max_evaluations
+        self.n_points = n_points
+        self.n_evaluations = 0
+        self.best = (None, None)  # point and value of the last line scan
+
+    def to_knobs(self, x):
+        return self.lower + x * (self.upper - self.lower)
+
+    def to_unit(self, knobs):
+        return (np.asarray(knobs, dtype=float) - self.lower) / (self.upper - self.lower)
+
+    def evaluate(self, x):
+        if np.any(x < 0) or np.any(x > 1):
+            return np.nan
+        if self.n_evaluations >= self.max_evaluations:
+            raise BudgetExhausted
+        self.n_evaluations += 1
+        return self.func(self.to_knobs(x))
+
+    def bracket(self, x0, f0, direction):
+        """ steps out along +direction and -direction until the objective rises by 3 sigma """
+        threshold = 3 * self.noise
+        alpha_min, f_min = 0.0, f0
+        history = [(0.0, f0)]
+        limits = []
+        for sign in (1, -1):
+            if sign < 0 and f0 > f_min + threshold:
+                limits.append(0.0)  # minimum is clearly on the positive side
+                break
+            step = sign * self.step
+            while True:
+                value = self.evaluate(x0 + step * direction)
+                if np.isnan(value):  # out of bounds
+                    break
+                history.append((step, value))
+                if value < f_min:
+                    alpha_min, f_min = step, value
+                if value >= f_min + threshold:
+                    break
+                step = step * 2.618 if abs(step) < 0.1 else step + sign * 0.1
+            limits.append(max((alpha for alpha, _ in history if np.sign(alpha) == sign), key=abs, default=0.0))
+        alpha_1, alpha_2 = sorted(limits)
+        return alpha_min, f_min, alpha_1, alpha_2, history
+
+    def line_scan(self, x0, f0, direction):
+        alpha_min, f_min, alpha_1, alpha_2, history = self.bracket(x0, f0, direction)
+        if alpha_2 - alpha_1 <= 0:
+            return x0 + alpha_min * direction, f_min
+
+        # fill the bracket with n_points, reusing samples close to them
+        spacing = (alpha_2 - alpha_1) / (self.n_points - 1)
+        for alpha in np.linspace(alpha_1, alpha_2, self.n_points):
+            if min(abs(alpha - a) for a, _ in history) > spacing / 2:
+                value = self.evaluate(x0 + alpha * direction)
+                if not np.isnan(value):
+                    history.append((alpha, value))
+
+        alphas, values = np.array(sorted(history)).T
+        if len(alphas) >= 3:
+            coefficients = np.polyfit(alphas, values, 2)
+            if coefficients[0] > 0:
+                # the fitted minimum is an average over all samples, more reliable than the best single sample
+                grid = np.linspace(alpha_1, alpha_2, 1000)
+                fit = np.polyval(coefficients, grid)
+                i = np.argmin(fit)
+                return x0 + grid[i] * direction, fit[i]
+        i = np.argmin(values)
+        return x0 + alphas[i] * direction, values[i]
+
+    def run(self, knobs0, directions=None, f0=None):
+        """
+        returns best knobs, best objective value
+        f0: objective at knobs0 if already known, e.g. the mean of the repeated evaluations of the noise estimate
+        """
+        n = len(self.lower)
+        directions = np.eye(n) if directions is None else np.array(directions, dtype=float)
+        x0 = self.to_unit(knobs0)
+        self.best = (x0, f0)
+        try:
+            f0 = self.evaluate(x0) if f0 is None else f0
+            xm, fm = x0, f0
+            self.best = (xm, fm)
+            while True:
+                largest_decrease, k = 0.0, 0
+                for i in range(n):
+                    x1, f1 = self.line_scan(xm, fm, directions[:, i])
+                    if fm - f1 > largest_decrease:
+                        largest_decrease, k = fm - f1, i
+                    xm, fm = x1, f1
+                    self.best = (xm, fm)
+
+                # Powell: replace the direction of the largest decrease by the overall one if it is worth it
+                xt = 2 * xm - x0
+                ft = self.evaluate(xt) if np.all((xt >= 0) & (xt <= 1)) else np.nan
+                if not (np.isnan(ft) or f0 <= ft or
+                        2 * (f0 - 2 * fm + ft) * ((f0 - fm - largest_decrease) / (ft - f0)) ** 2 >= largest_decrease):
+                    new_direction = (xm - x0) / np.linalg.norm(xm - x0)
+                    if np.max(np.abs(new_direction @ directions)) < 0.9:
+                        directions = np.column_stack((np.delete(directions, k, axis=1), new_direction))
+                        xm, fm = self.line_scan(xm, fm, new_direction)
+                        self.best = (xm, fm)
+
+                if 2 * abs(f0 - fm) < self.tolerance * (abs(f0) + abs(fm)):
+                    break
+                x0, f0 = xm, fm
+        except BudgetExhausted:
+            print(f'Stopped after {self.n_evaluations} evaluations')
+        x, value = self.best
+        return self.to_knobs(x), value
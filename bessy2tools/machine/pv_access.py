@@ -0,0 +1,410 @@
+# batched access to groups of EPICS PVs
+import random
+import threading
+import time
+
+import numpy as np
+
+from bessy2tools.instrumentation import metrics
+
+try:
+    from epics import ca
+except ImportError:
+    ca = None
+
+
+def default_readback(pvname):
+    """ readback PV of a power supply setpoint """
+    return pvname.replace(':set', ':rdbk')
+
+
+def record_gets(pvnames, values, seconds):
+    """ read latency of every PV and a timeout for every PV which did not answer """
+    for pvname, value, elapsed in zip(pvnames, values, seconds):
+        metrics.observe('pv_get_seconds', elapsed, pv=pvname)
+        if value is None:
+            metrics.count('pv_timeouts', pv=pvname, operation='get')
+
+
+def timed_callback(callback, start):
+    """ put callback which also records the time from issuing the put until the IOC completed it """
+    def on_done(pvname):
+        metrics.observe('pv_put_seconds', time.perf_counter() - start, pv=pvname)
+        callback(pvname)
+    return on_done
+
+
+class EpicsBackend:
+    """
+    Channel Access via pyepics, channels are created once and kept open
+    channels which are not connected are never accessed (pyepics would raise): a get returns None for them,
+    a put raises for them before anything is written and a subscription is skipped
+    """
+
+    def __init__(self, timeout=1.0):
+        self.timeout = timeout
+        self.chids = {}
+        self.subscriptions = []
+
+    def connect(self, pvnames):
+        new = [pvname for pvname in pvnames if pvname not in self.chids]
+        if not new:
+            return
+        with metrics.timer('backend_seconds', operation='connect'):
+            for pvname in new:
+                self.chids[pvname] = ca.create_channel(pvname, connect=False, auto_cb=False)
+            # all connection requests are in flight, wait for them together
+            for pvname in new:
+                if not ca.connect_channel(self.chids[pvname], timeout=self.timeout):
+                    metrics.count('pv_timeouts', pv=pvname, operation='connect')
+                    print(f'Could not connect to {pvname}')
+
+    def is_connected(self, pvname):
+        return ca.isConnected(self.chids[pvname])
+
+    def get_many(self, pvnames):
+        """ one request for all PVs: issue every get, flush once, then collect, None for unconnected PVs """
+        self.connect(pvnames)
+        chids = [self.chids[pvname] if self.is_connected(pvname) else None for pvname in pvnames]
+        start = time.perf_counter()
+        for chid in chids:
+            if chid is not None:
+                ca.get(chid, wait=False)
+        ca.poll()
+        if not metrics.enabled:
+            return [ca.get_complete(chid, timeout=self.timeout) if chid is not None else None for chid in chids]
+
+        # the answers arrive in parallel, the latency of a PV is the time until its answer was collected
+        values, seconds = [], []
+        for chid in chids:
+            values.append(ca.get_complete(chid, timeout=self.timeout) if chid is not None else None)
+            seconds.append(time.perf_counter() - start)
+        metrics.observe('backend_seconds', seconds[-1] if seconds else 0.0, operation='get_many')
+        record_gets(pvnames, values, seconds)
+        return values
+
+    def put_many(self, pvnames, values, callback=None):
+        """
+        issues all puts at once without waiting, callback(pvname) is called when the IOC completed a put
+        raises if a PV is not connected, nothing is written then
+        """
+        self.connect(pvnames)
+        unconnected = [pvname for pvname in pvnames if not self.is_connected(pvname)]
+        if unconnected:
+            for pvname in unconnected:
+                metrics.count('pv_timeouts', pv=pvname, operation='put')
+            raise Exception(f'Not connected: {unconnected}')
+        if metrics.enabled and callback is not None:
+            callback = timed_callback(callback, time.perf_counter())
+        for pvname, value in zip(pvnames, values):
+            on_done = (lambda pvname=pvname, **kwargs: callback(pvname)) if callback else None
+            ca.put(self.chids[pvname], value, wait=False, callback=on_done)
+        ca.poll()
+
+    def subscribe(self, pvname, callback):
+        """ callback(pvname, value) is called from the CA thread on every value change """
+        self.connect([pvname])
+        if not self.is_connected(pvname):
+            print(f'Not subscribed to {pvname}, it is not connected')
+            return
+
+        def on_monitor(pvname=None, value=None, **kwargs):
+            callback(pvname, value)
+
+        # keep the references, pyepics drops the callback otherwise
+        self.subscriptions.append(ca.create_subscription(self.chids[pvname], callback=on_monitor))
+
+
+class LocalBackend:
+    """
+    in-process stand-in for an IOC: values live in a dict, every request costs one latency
+    unknown PVs start with a random value, so the GUI can be used without EPICS
+    with relaxation_time > 0 readbacks approach their setpoints exponentially instead of following immediately
+    """
+
+    def __init__(self, values=None, latency=0.0, readback=default_readback, relaxation_time=0.0, update_interval=0.05):
+        self.values = dict(values or {})
+        self.latency = latency
+        self.readback = readback
+        self.relaxation_time = relaxation_time
+        self.update_interval = update_interval
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.relaxing = {}  # pvname -> token of the latest relax call, which wins over earlier ones
+
+    def connect(self, pvnames):
+        with self.lock:
+            for pvname in pvnames:
+                self.values.setdefault(pvname, random.uniform(-3, 3))
+
+    def get_many(self, pvnames):
+        start = time.perf_counter()
+        time.sleep(self.latency)
+        with self.lock:
+            values = [self.values.get(pvname) for pvname in pvnames]
+        if metrics.enabled:
+            seconds = time.perf_counter() - start
+            metrics.observe('backend_seconds', seconds, operation='get_many')
+            record_gets(pvnames, values, [seconds] * len(pvnames))
+        return values
+
+    def put_many(self, pvnames, values, callback=None):
+        """ the values are applied after one latency, readbacks follow immediately or relax towards them """
+        if metrics.enabled and callback is not None:
+            callback = timed_callback(callback, time.perf_counter())
+
+        def complete():
+            self.update(dict(zip(pvnames, values)))
+            if self.readback is not None:
+                readbacks = {self.readback(pvname): value for pvname, value in zip(pvnames, values)}
+                if self.relaxation_time:
+                    self.relax(readbacks, self.relaxation_time)
+                else:
+                    self.update(readbacks)
+            if callback is not None:
+                for pvname in pvnames:
+                    callback(pvname)
+
+        if self.latency:
+            threading.Timer(self.latency, complete).start()
+        else:
+            complete()
+
+    def subscribe(self, pvname, callback):
+        self.connect([pvname])
+        with self.lock:
+            self.subscribers.setdefault(pvname, []).append(callback)
+            value = self.values[pvname]
+        callback(pvname, value)  # like CA, a new monitor gets the current value first
+
+    def update(self, values):
+        """ change values as the IOC would, subscribers are notified """
+        with self.lock:
+            self.values.update(values)
+            callbacks = [(callback, pvname, value) for pvname, value in values.items()
+                         for callback in self.subscribers.get(pvname, ())]
+        for callback, pvname, value in callbacks:
+            callback(pvname, value)
+
+    def relax(self, targets, relaxation_time):
+        """
+        moves values exponentially towards targets in the background, updated every update_interval,
+        e.g. a readback following its setpoint or the lifetime after a magnet change
+        """
+        token = object()
+        with self.lock:
+            self.relaxing.update(dict.fromkeys(targets, token))
+        fraction = np.exp(-self.update_interval / relaxation_time)
+
+        def run():
+            while True:
+                time.sleep(self.update_interval)
+                with self.lock:
+                    current = {pvname: self.values.get(pvname, target) for pvname, target in targets.items()
+                               if self.relaxing.get(pvname) is token}
+                if not current:
+                    return
+                new_values = {}
+                for pvname, value in current.items():
+                    target = targets[pvname]
+                    value = target + (value - target) * fraction
+                    new_values[pvname] = target if abs(value - target) <= 1e-9 * max(1.0, abs(target)) else value
+                self.update(new_values)
+                with self.lock:
+                    for pvname, value in new_values.items():
+                        if value == targets[pvname] and self.relaxing.get(pvname) is token:
+                            del self.relaxing[pvname]
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+def default_backend():
+    if ca is None:
+        print('Epics is not installed, using local stand-in values')
+        return LocalBackend()
+    return EpicsBackend()
+
+
+class PVGroup:
+    """ a fixed list of PVs which are connected once and always read together """
+
+    def __init__(self, pvnames, backend=None):
+        self.pvnames = list(pvnames)
+        self.backend = backend if backend is not None else default_backend()
+        self.backend.connect(self.pvnames)
+
+    def get_all(self):
+        """ dict pvname -> value, None if a PV did not answer """
+        return dict(zip(self.pvnames, self.backend.get_many(self.pvnames)))
+
+
+class SinglePV:
+    """ get and put of one PV through a backend, for scripts written against epics.PV """
+
+    def __init__(self, pvname, backend=None):
+        self.pvname = pvname
+        self.backend = backend if backend is not None else default_backend()
+        self.backend.connect([pvname])
+
+    def get(self):
+        return self.backend.get_many([self.pvname])[0]
+
+    def put(self, value):
+        self.backend.put_many([self.pvname], [value])
+
+
+class WriteError(Exception):
+    pass
+
+
+class SetpointWriter:
+    """
+    writes many setpoints at once: all puts are issued together and completed via put callbacks under one overall
+    timeout, then the readbacks are checked against the targets within tolerance
+    with n_steps > 1 all setpoints are ramped together in interpolated steps
+    if anything fails the restore values are written back (without ramp) and a WriteError is raised
+    """
+
+    def __init__(self, backend=None, readback=default_readback, tolerance=1e-2, timeout=10.0):
+        self.backend = backend if backend is not None else default_backend()
+        self.readback = readback
+        self.tolerance = tolerance
+        self.timeout = timeout
+
+    def write(self, values, n_steps=1, step_time=0.0, restore=None):
+        with metrics.timer('setpoint_write_seconds'):
+            self._write(values, n_steps, step_time, restore)
+
+    def _write(self, values, n_steps, step_time, restore):
+        pvnames = list(values)
+        targets = np.array([values[pvname] for pvname in pvnames], dtype=float)
+        deadline = time.monotonic() + self.timeout
+        try:
+            if n_steps > 1:
+                start = np.array([np.nan if value is None else value for value in self.backend.get_many(pvnames)])
+                missing = [pvnames[i] for i in np.flatnonzero(np.isnan(start))]
+                if missing:
+                    raise WriteError(f'No value to ramp from for {missing}')
+            else:
+                start = targets
+            for step in range(1, n_steps + 1):
+                step_start = time.monotonic()
+                self._put_and_wait(pvnames, start + (targets - start) * step / n_steps, deadline)
+                if step < n_steps:
+                    time.sleep(max(0.0, min(step_time - (time.monotonic() - step_start), deadline - time.monotonic())))
+            self._verify(pvnames, targets, deadline)
+        except WriteError as error:
+            metrics.count('setpoint_write_errors')
+            if restore is not None:
+                print('Writing setpoints failed, restoring previous values')
+                try:
+                    self.write(restore)
+                except WriteError as restore_error:
+                    raise WriteError(f'{error}, restoring failed as well: {restore_error}') from error
+            raise
+
+    def _put_and_wait(self, pvnames, values, deadline):
+        pending = set(pvnames)
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def on_done(pvname):
+            with lock:
+                pending.discard(pvname)
+                if not pending:
+                    done.set()
+
+        try:
+            self.backend.put_many(pvnames, values.tolist(), callback=on_done)
+        except Exception as error:  # e.g. ChannelAccessException, a write error as anything else so that restore runs
+            raise WriteError(f'Put failed: {error}') from error
+        if not done.wait(max(0.0, deadline - time.monotonic())):
+            for pvname in list(pending):
+                metrics.count('pv_timeouts', pv=pvname, operation='put')
+            raise WriteError(f'Put not completed for {sorted(pending)}')
+
+    def _verify(self, pvnames, targets, deadline):
+        """ readbacks may need some time to follow, poll them until the deadline """
+        readbacks = [self.readback(pvname) for pvname in pvnames] if self.readback is not None else pvnames
+        while True:
+            values = np.array([np.nan if value is None else value for value in self.backend.get_many(readbacks)])
+            off = ~(np.abs(values - targets) <= self.tolerance)
+            if not off.any():
+                return
+            if time.monotonic() > deadline:
+                raise WriteError(f'Readbacks out of tolerance: {[readbacks[i] for i in np.flatnonzero(off)]}')
+            metrics.count('readback_retries')
+            time.sleep(0.05)
+
+
+class MonitorCache:
+    """
+    latest value of every PV, kept up to date by monitors in the background
+    reading the snapshot never touches the network, pop_changed returns what changed since the last call
+    """
+
+    def __init__(self, pvnames, backend=None):
+        self.pvnames = list(pvnames)
+        self.backend = backend if backend is not None else default_backend()
+        self.lock = threading.Lock()
+        self.values = {}
+        self.changed = {}
+        self.arrived = {}  # pvname -> time of the first change not popped yet, only while metrics are enabled
+        for pvname in self.pvnames:
+            self.backend.subscribe(pvname, self.on_value)
+
+    def on_value(self, pvname, value):
+        with self.lock:
+            self.values[pvname] = value
+            self.changed[pvname] = value
+            if metrics.enabled:
+                self.arrived.setdefault(pvname, time.perf_counter())
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def pop_changed(self):
+        with self.lock:
+            changed, self.changed = self.changed, {}
+            arrived, self.arrived = self.arrived, {}
+        if arrived:
+            # time a monitor update waited for the consumer, large values point to a slow loop rather than the network
+            now = time.perf_counter()
+            for pvname, arrival in arrived.items():
+                metrics.observe('monitor_wait_seconds', now - arrival)
+        return changed
+
+    def is_complete(self):
+        with self.lock:
+            return len(self.values) == len(self.pvnames)
+
+
+class SampleCollector:
+    """ collects the next n monitor updates of every signal, all signals are acquired at the same time """
+
+    def __init__(self, pvnames, backend):
+        self.pvnames = list(pvnames)
+        self.condition = threading.Condition()
+        self.samples = None
+        for pvname in self.pvnames:
+            backend.subscribe(pvname, self.on_value)
+
+    def on_value(self, pvname, value):
+        with self.condition:
+            if self.samples is not None and value is not None:
+                self.samples[pvname].append(value)
+                self.condition.notify_all()
+
+    def collect(self, n_samples, timeout):
+        """ dict pvname -> samples, fewer than n_samples if a signal did not update often enough within timeout """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.samples = {pvname: [] for pvname in self.pvnames}
+            while any(len(samples) < n_samples for samples in self.samples.values()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            samples, self.samples = self.samples, None
+        return {pvname: values[:n_samples] for pvname, values in samples.items()}
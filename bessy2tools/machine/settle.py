@@ -0,0 +1,107 @@
+# waiting for the machine to settle after setpoints were written
+import math
+import threading
+import time
+
+from bessy2tools.instrumentation import metrics
+from bessy2tools.machine.pv_access import default_backend, default_readback
+
+
+class Settle:
+    """
+    waits until the machine has settled, driven by monitors instead of fixed sleeps:
+    first all readbacks are within tolerance of their setpoints, then every signal (lifetime, injection efficiency)
+    stays within its tolerance for window seconds. timeout is the upper bound of a wait.
+    signals: dict pvname -> tolerance, tolerance: readback tolerance, a number or dict setpoint pvname -> number
+    """
+
+    def __init__(self, signals=None, backend=None, readback=default_readback, tolerance=1e-2, window=1.0,
+                 timeout=10.0):
+        self.backend = backend if backend is not None else default_backend()
+        self.readback = readback
+        self.tolerance = tolerance
+        self.window = window
+        self.timeout = timeout
+        self.signal_tolerances = dict(signals or {})
+        self.condition = threading.Condition()
+        self.values = {}
+        self.signal_references = {}  # pvname -> (value, time) of the last change beyond tolerance
+        self.subscribed = set()
+        self.last_duration = None
+        self.subscribe(self.signal_tolerances)
+
+    def subscribe(self, pvnames):
+        for pvname in pvnames:
+            if pvname not in self.subscribed:
+                self.subscribed.add(pvname)
+                self.backend.subscribe(pvname, self.on_value)
+
+    def on_value(self, pvname, value):
+        with self.condition:
+            self.values[pvname] = value
+            tolerance = self.signal_tolerances.get(pvname)
+            # None: the PV is disconnected, a signal without value is not stable
+            if value is None:
+                self.signal_references.pop(pvname, None)
+            elif tolerance is not None:
+                reference = self.signal_references.get(pvname)
+                if reference is None or abs(value - reference[0]) > tolerance:
+                    self.signal_references[pvname] = (value, time.monotonic())
+            self.condition.notify_all()
+
+    def get_tolerance(self, pvname):
+        return self.tolerance[pvname] if isinstance(self.tolerance, dict) else self.tolerance
+
+    def readbacks_reached(self, targets):
+        for pvname, target in targets.items():
+            value = self.values.get(pvname)
+            if value is None or not abs(value - target[0]) <= target[1]:
+                return False
+        return True
+
+    def signals_stable_since(self, start):
+        """
+        time at which all signals have been stable for window seconds, counted from start at the earliest,
+        infinite as long as a signal has no value
+        """
+        if not self.signal_tolerances:
+            return start
+        if len(self.signal_references) < len(self.signal_tolerances):
+            return math.inf
+        return max([start] + [reference[1] for reference in self.signal_references.values()]) + self.window
+
+    def wait(self, setpoints=None, timeout=None):
+        """
+        setpoints: dict setpoint pvname -> value which was written, their readbacks are awaited
+        returns True once settled, False if the timeout is reached first
+        """
+        setpoints = setpoints or {}
+        targets = {self.readback(pvname) if self.readback is not None else pvname:
+                   (value, self.get_tolerance(pvname)) for pvname, value in setpoints.items()}
+        self.subscribe(targets)
+        start = time.monotonic()
+        deadline = start + (timeout if timeout is not None else self.timeout)
+        with self.condition:
+            # signals only count as stable once the readbacks arrived
+            while not self.readbacks_reached(targets):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.count('settle_timeouts', reason='readbacks')
+                    print(f'Readbacks did not reach their setpoints within {deadline - start:.1f} s')
+                    return False
+                self.condition.wait(remaining)
+            reached = time.monotonic()
+            while True:
+                settled = self.signals_stable_since(reached)
+                now = time.monotonic()
+                if now >= settled:
+                    self.last_duration = now - start
+                    metrics.observe('settle_seconds', self.last_duration)
+                    return True
+                if now >= deadline:
+                    metrics.count('settle_timeouts', reason='signals')
+                    missing = sorted(set(self.signal_tolerances) - set(self.signal_references))
+                    print(f'Signals did not settle within {deadline - start:.1f} s'
+                          + (f', no value from {missing}' if missing else ''))
+                    return False
+                self.condition.wait(min(settled, deadline) - now)
@@ -0,0 +1,122 @@
+# virtual BESSY II: an in-process backend with machine state, ramp rates, latency and noise
+import threading
+import time
+
+import numpy as np
+
+from bessy2tools.machine.pv_access import LocalBackend, default_readback
+from bessy2tools.quad_conversion.name_conversion import quad_list_epics
+
+SEXTUPOLES = ('S3PTR', 'S4PDR', 'S4PTR', 'S4P1T6R')  # knobs of tune_optimizer.py
+TUNE_X, TUNE_Y = 'TUNEZR:rdH', 'TUNEZR:rdV'
+TUNE_CORRECTION = 'TUNEXPV:sign_apply'
+CURRENT = 'CUMZR:rdCur'
+LIFETIME = 'TOPUPCC:rdLT'
+PHASE, PHASE_READBACK = 'PAHB:sDelay', 'PAHB:pDelay'
+INJECTION_EFFICIENCIES = ('TOPUP1T5G:rdEffBoostRraw', 'TOPUP2T5G:rdEffBoostRraw')
+
+
+def readback(pvname):
+    return PHASE_READBACK if pvname == PHASE else default_readback(pvname)
+
+
+class VirtualBessy(LocalBackend):
+    """
+    stand-in for the PVs of quad_conversion, tune_optimizer.py and phace_acceptance.py with a simple machine model:
+    - power supply and phase readbacks follow their setpoints with ramp_rate (units per second)
+    - the tunes (kHz) depend linearly on the quad and sextupole settings, TUNEXPV:sign_apply shifts the horizontal tune
+    - the lifetime (h) is maximal at an optimum of the sextupoles, which differs from the initial values
+    - the beam current (mA) decays with the lifetime and is topped up to current_max
+    - the injection efficiencies (%) are high within a phase acceptance window and updated with every shot
+    every read and write costs latency seconds, noise is the relative noise of all signals
+    """
+
+    def __init__(self, latency=0.0, ramp_rate=50.0, noise=0.002, update_interval=0.05, shot_interval=0.1,
+                 current_max=300.0, seed=None):
+        self.random = np.random.default_rng(seed)
+        self.setpoints = [magnet + ':set' for magnet in quad_list_epics + list(SEXTUPOLES)] + [PHASE]
+        initial = self.random.uniform(50, 150, len(self.setpoints))
+        initial[-1] = 1.0  # phase within the acceptance, so that top-up works
+        values = dict(zip(self.setpoints, initial))
+        values.update({readback(pvname): value for pvname, value in zip(self.setpoints, initial)})
+        values.update({TUNE_X: 1240.0, TUNE_Y: 730.0, TUNE_CORRECTION: 0, CURRENT: current_max, LIFETIME: 8.0})
+        values.update(dict.fromkeys(INJECTION_EFFICIENCIES, 0.0))
+        super().__init__(values, latency=latency, readback=None)
+
+        self.ramp_rate = ramp_rate
+        self.noise = noise
+        self.update_interval = update_interval
+        self.shot_interval = shot_interval
+        self.current_max = current_max
+        self.initial = initial
+        n_quads = len(quad_list_epics)
+        self.tune_sensitivity = self.random.normal(0, 20, (2, len(self.setpoints) - 1))  # kHz per relative change
+        self.tune_sensitivity[:, n_quads:] *= 0.1  # sextupoles shift the tunes only a little
+        self.tune_offset = 0.0
+        self.sextupole_optimum = initial[n_quads:-1] * (1 + self.random.uniform(-2e-4, 2e-4, len(SEXTUPOLES)))
+        self.lifetime_max = 10.0
+        self.acceptance = (0.6, 1.4)
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def put_many(self, pvnames, values, callback=None):
+        def complete():
+            self.update(dict(zip(pvnames, values)))
+            for pvname, value in zip(pvnames, values):
+                if pvname == TUNE_CORRECTION:
+                    with self.lock:
+                        self.tune_offset += 0.5 * np.sign(value)
+            if callback is not None:
+                for pvname in pvnames:
+                    callback(pvname)
+
+        if self.latency:
+            threading.Timer(self.latency, complete).start()
+        else:
+            complete()
+
+    def get_model(self, readbacks):
+        """ tunes, lifetime and mean injection efficiency for the given readbacks of all setpoints """
+        relative = readbacks[:-1] / self.initial[:-1] - 1
+        tunes = np.array([1240.0, 730.0]) + self.tune_sensitivity @ relative
+        tunes[0] += self.tune_offset
+        sextupoles = readbacks[len(quad_list_epics):-1]
+        deviation = (sextupoles - self.sextupole_optimum) / (self.sextupole_optimum * 1e-3)
+        lifetime = max(0.1, self.lifetime_max * (1 - 0.5 * np.sum(deviation ** 2)))
+        phase = readbacks[-1]
+        edges = 1 / (1 + np.exp(-(phase - self.acceptance[0]) / 0.02)) / (1 + np.exp((phase - self.acceptance[1]) / 0.02))
+        return tunes, lifetime, 100 * edges
+
+    def run(self):
+        readback_names = [readback(pvname) for pvname in self.setpoints]
+        last = time.monotonic()
+        next_shot = last
+        while self.running:
+            time.sleep(self.update_interval)
+            now = time.monotonic()
+            dt, last = now - last, now
+            with self.lock:
+                setpoints = np.array([self.values[pvname] for pvname in self.setpoints], dtype=float)
+                readbacks = np.array([self.values[pvname] for pvname in readback_names], dtype=float)
+                current = self.values[CURRENT]
+
+            step = np.clip(setpoints - readbacks, -self.ramp_rate * dt, self.ramp_rate * dt)
+            changed = step != 0
+            readbacks += step
+            tunes, lifetime, efficiency = self.get_model(readbacks)
+            current *= np.exp(-dt / (lifetime * 3600))
+            new_values = {readback_names[i]: readbacks[i] for i in np.flatnonzero(changed)}
+            new_values.update({TUNE_X: tunes[0] * (1 + 1e-4 * self.noise * self.random.normal()),
+                               TUNE_Y: tunes[1] * (1 + 1e-4 * self.noise * self.random.normal()),
+                               LIFETIME: lifetime * (1 + self.noise * self.random.normal())})
+            if now >= next_shot:
+                # top-up injection
+                next_shot = now + self.shot_interval
+                current = min(self.current_max, current + 0.01 * efficiency)
+                new_values.update({pvname: efficiency * (1 + self.noise * self.random.normal()) + self.noise *
+                                   self.random.normal() for pvname in INJECTION_EFFICIENCIES})
+            new_values[CURRENT] = current
+            self.update(new_values)
@@ -0,0 +1,153 @@
+# phase acceptance scan: step the booster-ring phase, sample injection efficiencies, stream the points to a csv file
+import csv
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from bessy2tools.machine.pv_access import default_backend, SampleCollector
+from bessy2tools.machine.settle import Settle
+
+
+class ScanFile:
+    """
+    append-only csv file, written by a background thread so that stepping never waits for the disk
+    every row is flushed when written, rows of an interrupted scan are read back to resume it
+    """
+
+    def __init__(self, path, fieldnames):
+        self.path = path
+        self.fieldnames = fieldnames
+        # a partial row of an interrupted write must not be read as data
+        self.truncate_incomplete_line()
+        self.rows = self.read()
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames)
+        if new:
+            self.writer.writeheader()
+            self.file.flush()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, newline='') as file:
+            reader = csv.DictReader(file)
+            if reader.fieldnames and reader.fieldnames != self.fieldnames:
+                raise Exception(f'{self.path} has the columns {reader.fieldnames}, expected {self.fieldnames}')
+            return [{key: float(value) for key, value in row.items()} for row in reader
+                    if None not in row.values() and '' not in row.values()]
+
+    def truncate_incomplete_line(self):
+        """ an interrupted write can leave an incomplete last line, which would be merged with the next row """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as file:
+            data = file.read()
+            if data and not data.endswith(b'\n'):
+                file.truncate(data.rfind(b'\n') + 1)
+
+    def append(self, row):
+        self.rows.append(row)
+        self.queue.put(row)
+
+    def run(self):
+        while True:
+            row = self.queue.get()
+            if row is None:
+                return
+            self.writer.writerow(row)
+            self.file.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+class PhaseScan:
+    """
+    scans a setpoint and measures the mean and spread of n_samples monitor updates of every signal per point
+    a coarse scan is refined by bisection where the efficiency crosses threshold * maximum (the acceptance edges)
+    until the points are min_step apart. points already in the file are not measured again, so an interrupted scan
+    is resumed by running it with the same file.
+    """
+
+    def __init__(self, path, setpoint, readback, signals, backend=None, n_samples=5, sample_timeout=5.0,
+                 tolerance=0.005, signal_tolerance=1.0, settle_window=0.5, settle_timeout=2.0, threshold=0.5):
+        self.backend = backend if backend is not None else default_backend()
+        self.setpoint = setpoint
+        self.readback = readback
+        self.signals = list(signals)
+        self.n_samples = n_samples
+        self.sample_timeout = sample_timeout
+        self.tolerance = tolerance
+        self.threshold = threshold
+        self.settle = Settle(dict.fromkeys(self.signals, signal_tolerance), backend=self.backend,
+                             readback={setpoint: readback}.get, tolerance=tolerance, window=settle_window,
+                             timeout=settle_timeout)
+        self.collector = SampleCollector(self.signals, self.backend)
+        fieldnames = ['setpoint', 'readback', 'time']
+        for signal in self.signals:
+            fieldnames += [f'{signal}_mean', f'{signal}_std', f'{signal}_n']
+        self.file = ScanFile(path, fieldnames)
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def rows(self):
+        return sorted(self.file.rows, key=lambda row: row['setpoint'])
+
+    def is_measured(self, value):
+        return any(abs(row['setpoint'] - value) < self.tolerance / 2 for row in self.file.rows)
+
+    def measure(self, value):
+        self.backend.put_many([self.setpoint], [value])
+        self.settle.wait({self.setpoint: value})
+        samples = self.collector.collect(self.n_samples, self.sample_timeout)
+        readback = self.settle.values.get(self.readback)
+        row = dict(setpoint=float(value), readback=np.nan if readback is None else readback, time=time.time())
+        for signal, values in samples.items():
+            row[f'{signal}_mean'] = float(np.mean(values)) if values else np.nan
+            row[f'{signal}_std'] = float(np.std(values)) if values else np.nan
+            row[f'{signal}_n'] = len(values)
+        self.file.append(row)
+        return row
+
+    def run(self, values):
+        """ measures all values not in the file yet, returns the number of measured points """
+        todo = [value for value in values if not self.is_measured(value)]
+        for i, value in enumerate(todo, 1):
+            row = self.measure(value)
+            print(f'[{i}/{len(todo)}] {self.setpoint} = {value:.4f}: ' +
+                  ', '.join(f'{signal} = {row[f"{signal}_mean"]:.2f}' for signal in self.signals))
+        return len(todo)
+
+    def get_efficiency(self, rows):
+        return np.nanmean([[row[f'{signal}_mean'] for signal in self.signals] for row in rows], axis=1)
+
+    def get_edges(self, min_step):
+        """ midpoints of neighbouring points which are further apart than min_step and lie on both sides of the edge """
+        rows = self.rows
+        if len(rows) < 2:
+            return []
+        setpoints = np.array([row['setpoint'] for row in rows])
+        above = self.get_efficiency(rows) >= self.threshold * np.nanmax(self.get_efficiency(rows))
+        crossing = (above[1:] != above[:-1]) & (np.diff(setpoints) > min_step * 1.5)
+        return ((setpoints[1:] + setpoints[:-1]) / 2)[crossing].tolist()
+
+    def scan(self, start, end, coarse_step, min_step):
+        """ coarse scan from start to end, then refinement at the edges, returns the measured rows """
+        self.run(np.linspace(start, end, int(round((end - start) / coarse_step)) + 1))
+        while True:
+            edges = [value for value in self.get_edges(min_step) if not self.is_measured(value)]
+            if not edges:
+                return self.rows
+            print(f'Refining {len(edges)} edges')
+            self.run(edges)
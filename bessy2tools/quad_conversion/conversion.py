@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from bessy2tools.quad_conversion.name_conversion import short2epics, quad_list_epics
+
+
+class LatticeFileError(ValueError):
+    pass
+
+
+class LatticeStore:
+    """
+    Lattice and PS files parsed once and cached by path and modification time, so switching between files already
+    opened costs no parsing. Magnet names are validated against name_conversion when a file is read.
+    Each entry holds the values by EPICS name and as array aligned with magnets (quad_list_epics).
+    """
+
+    def __init__(self, magnets=quad_list_epics, skip=('QIT6',)):
+        self.magnets = list(magnets)
+        self.index = {magnet: i for i, magnet in enumerate(self.magnets)}
+        self.skip = skip
+        self.entries = {}  # (path, lattice_file) -> (modification time, values, array)
+
+    def parse(self, path, lattice_file):
+        with open(path) as file:
+            json_dict = json.load(file)
+        if lattice_file:
+            quads = {short: attributes["k1"] for short, attributes in json_dict["elements"].items()
+                     if attributes["type"] == "Quad" and short not in self.skip}
+            unknown = [short for short in quads if short not in short2epics]
+            values = {short2epics[short]: k1 for short, k1 in quads.items() if short in short2epics}
+        else:
+            unknown = [magnet for magnet in json_dict if magnet not in self.index]
+            values = json_dict
+        if unknown:
+            raise LatticeFileError(f'{path}: unknown magnets {unknown}')
+
+        array = np.full(len(self.magnets), np.nan)
+        for magnet, value in values.items():
+            array[self.index[magnet]] = value
+        return values, array
+
+    def get(self, path, lattice_file):
+        """ values (dict, do not modify) and aligned array of a file, parsed only if it is new or changed on disk """
+        key = (os.path.abspath(path), lattice_file)
+        stat = os.stat(path)
+        mtime = (stat.st_mtime_ns, stat.st_size)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != mtime:
+            entry = self.entries[key] = (mtime, *self.parse(path, lattice_file))
+        return entry[1], entry[2]
+
+    def get_values(self, path, lattice_file):
+        return dict(self.get(path, lattice_file)[0])
+
+    def get_array(self, path, lattice_file):
+        return self.get(path, lattice_file)[1]
+
+    def get_paths(self, lattice_file):
+        """ all files of a kind that were opened, to switch between them """
+        return sorted(path for path, is_lattice_file in self.entries if is_lattice_file == lattice_file)
+
+
+lattice_store = LatticeStore()
+
+
+def load_quad_values(path, lattice_file):
+    """ lattice file: k1 of all quads (except QIT6) by EPICS name, otherwise the file is already a dict of values """
+    return lattice_store.get_values(path, lattice_file)
+
+
+class QuadConversion:
+    """
+    Headless k -> PS value conversion, all values are float arrays aligned with magnets (quad_list_epics),
+    NaN where a magnet has no value. k can also be a stack of candidate lattices (n_candidates x n_magnets).
+    """
+
+    def __init__(self, ref_quad_values, ref_PS_values, magnets=quad_list_epics):
+        self.magnets = list(magnets)
+        self.index = {magnet: i for i, magnet in enumerate(self.magnets)}
+        self.ref_k = self.to_array(ref_quad_values)
+        self.ref_PS = self.to_array(ref_PS_values)
+
+    def to_array(self, values):
+        array = np.full(len(self.magnets), np.nan)
+        for magnet, value in values.items():
+            array[self.index[magnet]] = value
+        return array
+
+    def to_dict(self, array, mask=None):
+        indices = np.flatnonzero(mask if mask is not None else np.isfinite(array))
+        return {self.magnets[i]: value for i, value in zip(indices.tolist(), array[indices].tolist())}
+
+    def get_changed(self, k):
+        """ magnets whose k differs from the reference and can be converted """
+        return np.isfinite(k) & (k != self.ref_k) & np.isfinite(self.ref_k) & np.isfinite(self.ref_PS)
+
+    def compute(self, k):
+        """ returns new PS values, ratio to the reference PS values and the mask of changed magnets """
+        changed = self.get_changed(k)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_PS = np.where(changed, k * self.ref_PS / self.ref_k, np.nan)
+            return new_PS, new_PS / self.ref_PS, changed
+
+    @staticmethod
+    def interpolate(k, second_k, knob):
+        """ multiknob: knob = 0 -> k, knob = 1 -> second_k, an array of knob values gives a stack of lattices """
+        knob = np.asarray(knob, dtype=float)[..., np.newaxis]
+        return np.where(k == second_k, k, (1 - knob) * k + knob * second_k)
+
+
+class Multiknob:
+    """
+    Blends a base lattice with any number of further lattices (a simplex of lattices):
+    k = k_0 + sum_i w_i (k_i - k_0) with w_i >= 0 and sum_i w_i <= 1, weights are rescaled if their sum exceeds 1.
+    The deltas in k and PS values are computed once, a knob step is one multiply-add over the magnets that differ
+    between the lattices and returns which of them changed.
+    """
+
+    def __init__(self, conversion, lattices):
+        self.conversion = conversion
+        base_k = lattices[0]
+        delta_k = np.array(lattices[1:]).reshape(len(lattices) - 1, len(base_k)) - base_k
+        self.active = np.flatnonzero(np.any(delta_k != 0, axis=0) & np.isfinite(base_k))
+        self.base_k = base_k[self.active]
+        self.delta_k = delta_k[:, self.active]
+        self.ref_k = conversion.ref_k[self.active]
+        self.convertible = np.isfinite(self.ref_k) & np.isfinite(conversion.ref_PS[self.active])
+        scale = conversion.ref_PS[self.active] / self.ref_k
+        self.base_PS = self.base_k * scale
+        self.delta_PS = self.delta_k * scale
+        self.k = base_k.copy()
+        self.PS = np.where(conversion.get_changed(base_k), base_k * conversion.ref_PS / conversion.ref_k, np.nan)
+
+    def get_weights(self, weights):
+        weights = np.clip(np.asarray(weights, dtype=float), 0, None)
+        return weights / max(1.0, weights.sum())
+
+    def step(self, weights):
+        """ updates k and PS for the given weights, returns the indices (into magnets) of the changed values """
+        weights = self.get_weights(weights)
+        k = self.base_k + weights @ self.delta_k
+        changed = k != self.k[self.active]
+        self.k[self.active] = k
+        self.PS[self.active] = np.where(self.convertible & (k != self.ref_k), self.base_PS + weights @ self.delta_PS,
+                                        np.nan)
+        return self.active[changed]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Convert quadrupole k values of a lattice file to PS values.')
+    parser.add_argument('new_lattice')
+    parser.add_argument('ref_lattice')
+    parser.add_argument('ref_PS_values')
+    parser.add_argument('--second-lattice', help='multiknob: interpolate between new and second lattice')
+    parser.add_argument('--knob', type=float, default=0.0)
+    parser.add_argument('-o', '--output', help='write the new PS values (changed magnets only) to a json file')
+    args = parser.parse_args(args)
+
+    conversion = QuadConversion(load_quad_values(args.ref_lattice, True), load_quad_values(args.ref_PS_values, False))
+    k = lattice_store.get_array(args.new_lattice, True)
+    if args.second_lattice:
+        k = conversion.interpolate(k, lattice_store.get_array(args.second_lattice, True), args.knob)
+    new_PS, ratio, changed = conversion.compute(k)
+    new_PS_values = conversion.to_dict(new_PS, changed)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(new_PS_values, file, indent=2)
+    else:
+        for magnet, value in new_PS_values.items():
+            print(f'{magnet:10} {value:10.3f}   factor {ratio[conversion.index[magnet]]:.5f}')
+
+
+if __name__ == '__main__':
+    main()
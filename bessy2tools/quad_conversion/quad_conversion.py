@@ -1,22 +1,26 @@
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import ttk
-import os, json
-from name_conversion import epics2short, short2epics, quad_list_epics
-from tk_utils import grid_configure, ScrollSpinbox
-
-try:
-    from epics import caget, caput
-except:
-    import random
-
-    caget = caput = lambda *args: print("Epics is not installed") or random.uniform(-3, 3)
+import os, json, sys
+from bessy2tools.quad_conversion.name_conversion import quad_list_epics
+from bessy2tools.quad_conversion.tk_utils import grid_configure, ScrollSpinbox, TreeviewRows
+from bessy2tools.quad_conversion.conversion import QuadConversion, Multiknob, LatticeFileError, lattice_store
+from bessy2tools.instrumentation import metrics
+from bessy2tools.machine.pv_access import PVGroup, MonitorCache, SetpointWriter, WriteError
 
 DEBUG = True
+MONITOR_REFRESH_INTERVAL = 200  # ms, upper limit for the refresh rate of the current PS values
+RAMP_STEPS = 1  # > 1: ramp all power supplies together in interpolated steps
+RAMP_STEP_TIME = 0.5  # s
+EXAMPLE_VALUES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "example_values")
 
 
 class GUI:
-    def __init__(self):
+    def __init__(self, backend=None):
+        self.PS_setpoints = PVGroup([magnet + ':set' for magnet in quad_list_epics], backend)
+        self.PS_monitor = MonitorCache(self.PS_setpoints.pvnames, self.PS_setpoints.backend)
+        self.PS_writer = SetpointWriter(self.PS_setpoints.backend)
+        self.saved_PS_values = {}
         self.master = tk.Tk()
         self.master.withdraw()
         self.master.title("Quadrupole values")
@@ -29,12 +33,13 @@ class GUI:
         self.create_tree_view()
         self.create_bottom_frame()
         self.master.deiconify()
+        self.master.after(MONITOR_REFRESH_INTERVAL, self.refresh_current_PS_values)
 
         if DEBUG:
-            self.update_dict_from_file(self.new_quad_values, self.new_quad_values_path, "example_values/V3_max_center.json", True)
-            self.update_dict_from_file(self.ref_quad_values, self.ref_quad_values_path, "example_values/BII_2017-08-04_23-42_LOCOFitByPS_noID_ActualUserMode.json", True)
-            self.update_dict_from_file(self.ref_PS_values, self.ref_PS_values_path, "example_values/BII_2017-08-04_23-42_LOCOFitByPS_noID_ActualUserMode.values", False)
-            self.update_dict_from_file(self.second_new_quad_values, self.second_new_quad_values_path, "example_values/V3_min_center.json", True)
+            self.update_dict_from_file(self.new_quad_values, self.new_quad_values_path, EXAMPLE_VALUES + "/V3_max_center.json", True)
+            self.update_dict_from_file(self.ref_quad_values, self.ref_quad_values_path, EXAMPLE_VALUES + "/BII_2017-08-04_23-42_LOCOFitByPS_noID_ActualUserMode.json", True)
+            self.update_dict_from_file(self.ref_PS_values, self.ref_PS_values_path, EXAMPLE_VALUES + "/BII_2017-08-04_23-42_LOCOFitByPS_noID_ActualUserMode.values", False)
+            self.update_dict_from_file(self.second_new_quad_values, self.second_new_quad_values_path, EXAMPLE_VALUES + "/V3_min_center.json", True)
 
     def create_top_frame(self):
         self.top_frame = tk.Frame(self.master)
@@ -46,21 +51,22 @@ class GUI:
         self.ref_quad_values = {}
         self.ref_PS_values = {}
         self.present_PS_values = {}
+        self.computed_quad_values = self.new_quad_values  # the quad values the new PS values were computed from
 
         self.new_quad_values_path = tk.StringVar()
         self.button_new_quad_values = tk.Button(self.top_frame, text="New lattice file",
                                                 command=lambda: self.open_json_from_file(self.new_quad_values, self.new_quad_values_path, "New quad values", lattice_file=True))
-        self.label_new_quad_values = tk.Label(self.top_frame, textvariable=self.new_quad_values_path)
+        self.label_new_quad_values = self.create_path_selector(self.top_frame, self.new_quad_values, self.new_quad_values_path, lattice_file=True)
 
         self.ref_quad_values_path = tk.StringVar()
         self.button_ref_quad_values = tk.Button(self.top_frame, text="Ref lattice file",
                                                 command=lambda: self.open_json_from_file(self.ref_quad_values, self.ref_quad_values_path, "Ref quad values", lattice_file=True))
-        self.label_ref_quad_values = tk.Label(self.top_frame, textvariable=self.ref_quad_values_path)
+        self.label_ref_quad_values = self.create_path_selector(self.top_frame, self.ref_quad_values, self.ref_quad_values_path, lattice_file=True)
 
         self.ref_PS_values_path = tk.StringVar()
         self.button_ref_PS_values = tk.Button(self.top_frame, text="Ref PS values",
                                               command=lambda: self.open_json_from_file(self.ref_PS_values, self.ref_PS_values_path, "Ref PS values"))
-        self.label_ref_PS_values = tk.Label(self.top_frame, textvariable=self.ref_PS_values_path)
+        self.label_ref_PS_values = self.create_path_selector(self.top_frame, self.ref_PS_values, self.ref_PS_values_path, lattice_file=False)
 
         for i, (button, label) in enumerate(zip([self.button_new_quad_values, self.button_ref_quad_values, self.button_ref_PS_values],
                                                 [self.label_new_quad_values, self.label_ref_quad_values, self.label_ref_PS_values])):
@@ -75,17 +81,35 @@ class GUI:
         self.tree_view["show"] = "headings"
         for heading in headings:
             self.tree_view.heading(heading, text=heading)
+        self.tree_rows = TreeviewRows(self.tree_view, headings)
 
     def update_tree_view(self):  # correct new k valuet
-        self.tree_view.delete(*self.tree_view.get_children())
+        rows = {}
         if self.new_PS_values:
-            for i, magnet in enumerate(self.new_PS_values.keys()):
-                values = (magnet, self.new_PS_values[magnet], self.ref_PS_values[magnet], caget(magnet + ':set'),
-                          self.new_PS_values[magnet] / self.ref_PS_values[magnet], self.new_quad_values[magnet], self.ref_quad_values[magnet])
-                values = tuple(round(x, 3) if isinstance(x, float) else x for x in values)
-                self.tree_view.insert('', i, magnet, values=values)
+            current_PS_values = self.get_current_PS_values()
+            for magnet in self.new_PS_values.keys():
+                rows[magnet] = (magnet, self.new_PS_values[magnet], self.ref_PS_values[magnet], current_PS_values[magnet],
+                                self.new_PS_values[magnet] / self.ref_PS_values[magnet], self.computed_quad_values[magnet], self.ref_quad_values[magnet])
         else:
             print("Could not update Tree view")
+        self.tree_rows.set_rows(rows)
+
+    def update_tree_view_rows(self, magnets):
+        """ only the cells depending on the new values, the whole view if rows have to be added or removed """
+        if set(self.tree_rows.rows) != set(self.new_PS_values):
+            return self.update_tree_view()
+        for magnet in magnets:
+            if magnet in self.new_PS_values:
+                self.tree_rows.set_cells(magnet, {"New PS values": self.new_PS_values[magnet],
+                                                  "Factor": self.new_PS_values[magnet] / self.ref_PS_values[magnet],
+                                                  "New k values": self.computed_quad_values[magnet]})
+
+    def refresh_current_PS_values(self):
+        """ writes the monitor updates since the last call into the view, reschedules itself """
+        with metrics.timer('gui_seconds', operation='refresh'):
+            for pvname, value in self.PS_monitor.pop_changed().items():
+                self.tree_rows.set_cells(pvname[:-len(':set')], {"Current PS values": value})
+        self.master.after(MONITOR_REFRESH_INTERVAL, self.refresh_current_PS_values)
 
     def create_bottom_frame(self):
         self.bottom_frame = tk.Frame(self.master)
@@ -117,14 +141,68 @@ class GUI:
         self.multiknob.set(0)
 
         self.multiknob_frame = tk.Frame(self.master)
-        grid_configure(self.multiknob_frame, 1, 3, weight_col=[2, 1, 50])
-        self.button_second_new_quad_values = tk.Button(self.multiknob_frame, text="Second lattice file",
-                                                       command=lambda: self.open_json_from_file(self.second_new_quad_values, self.second_new_quad_values_path, "New quad values", lattice_file=True))
-        self.label_second_new_quad_values = tk.Label(self.multiknob_frame, textvariable=self.second_new_quad_values_path)
-        self.spinbox_multiknob = ScrollSpinbox(self.multiknob_frame, textvariable=self.multiknob, width=5, from_=0, to=1, increment=0.01, command=lambda: self.compute_multiknob_new_quad_values() or self.compute_new_PS_values(self.multiknob_new_quad_values) or self.update_tree_view())
-
-        for i, x in enumerate([self.button_second_new_quad_values, self.spinbox_multiknob, self.label_second_new_quad_values]):
-            x.grid(row=0, column=i, sticky="wens")
+        grid_configure(self.multiknob_frame, 1, 4, weight_col=[2, 1, 50, 1])
+        # (quad values, path, knob) of every lattice blended with the new lattice
+        self.multiknob_lattices = []
+        self.multiknob_engine = None
+        self.add_multiknob_lattice(self.second_new_quad_values, self.second_new_quad_values_path, self.multiknob)
+        self.button_add_multiknob_lattice = tk.Button(self.multiknob_frame, text="+", command=self.add_multiknob_lattice)
+        self.button_add_multiknob_lattice.grid(row=0, column=3, sticky="wens")
+
+    def add_multiknob_lattice(self, quad_values=None, path=None, knob=None):
+        quad_values = {} if quad_values is None else quad_values
+        path = tk.StringVar() if path is None else path
+        if knob is None:
+            knob = tk.DoubleVar()
+            knob.set(0)
+        row = len(self.multiknob_lattices)
+        button = tk.Button(self.multiknob_frame, text="Second lattice file" if row == 0 else f"Lattice file {row + 2}",
+                           command=lambda: self.open_json_from_file(quad_values, path, "New quad values", lattice_file=True))
+        label = self.create_path_selector(self.multiknob_frame, quad_values, path, lattice_file=True)
+        spinbox = ScrollSpinbox(self.multiknob_frame, textvariable=knob, width=5, from_=0, to=1, increment=0.01, command=self.multiknob_step)
+        for i, x in enumerate([button, spinbox, label]):
+            x.grid(row=row, column=i, sticky="wens")
+        self.multiknob_lattices.append((quad_values, path, knob))
+        self.multiknob_engine = None
+
+    def get_multiknob_engine(self):
+        """ built once after lattice files changed, a knob step then only updates the precomputed blend """
+        if self.multiknob_engine is None:
+            lattices = [self.new_quad_values] + [values for values, _, _ in self.multiknob_lattices if values]
+            if any(values.keys() != self.new_quad_values.keys() for values in lattices):
+                print("Multiknob lattices do not have the same Magnet!")
+                return None
+            if not set(self.new_quad_values.keys()).issubset(set(self.ref_PS_values.keys())):
+                print("Different Magnets!", set(self.new_quad_values.keys()) - set(self.ref_PS_values.keys()))
+                return None
+            conversion = QuadConversion(self.ref_quad_values, self.ref_PS_values)
+            self.multiknob_engine = Multiknob(conversion, [conversion.to_array(values) for values in lattices])
+            self.multiknob_new_quad_values.clear()
+            self.multiknob_new_quad_values.update(conversion.to_dict(self.multiknob_engine.k))
+            self.new_PS_values.clear()
+            self.new_PS_values.update(conversion.to_dict(self.multiknob_engine.PS))
+            self.computed_quad_values = self.multiknob_new_quad_values
+        return self.multiknob_engine
+
+    def multiknob_step(self):
+        # a new engine replaced all values, not only those of the magnets the knob moves
+        rebuilt = self.multiknob_engine is None
+        engine = self.get_multiknob_engine()
+        if engine is None:
+            return
+        self.computed_quad_values = self.multiknob_new_quad_values
+        changed = engine.step([knob.get() for values, _, knob in self.multiknob_lattices if values])
+        magnets = [engine.conversion.magnets[i] for i in changed.tolist()]
+        for magnet, k, PS in zip(magnets, engine.k[changed].tolist(), engine.PS[changed].tolist()):
+            self.multiknob_new_quad_values[magnet] = k
+            if PS == PS:
+                self.new_PS_values[magnet] = PS
+            else:
+                self.new_PS_values.pop(magnet, None)
+        if rebuilt:
+            self.update_tree_view()
+        else:
+            self.update_tree_view_rows(magnets)
 
     def toggle_multiknob_frame(self):
         if self.toggle_multiknob.get():
@@ -132,60 +210,67 @@ class GUI:
         else:
             self.multiknob_frame.grid_forget()
 
+    def create_path_selector(self, frame, dictionary, string_var, lattice_file):
+        """ shows the path of the loaded file, the drop down switches between all files of this kind opened so far """
+        combobox = ttk.Combobox(frame, textvariable=string_var, state="readonly")
+        combobox.configure(postcommand=lambda: combobox.configure(values=lattice_store.get_paths(lattice_file)))
+        combobox.bind("<<ComboboxSelected>>", lambda event: self.update_dict_from_file(dictionary, string_var, string_var.get(), lattice_file))
+        return combobox
+
     def open_json_from_file(self, dictionary, string_var, message, lattice_file=False):
-        path = tk.filedialog.askopenfilename(initialdir=os.getcwd() + "/example_values", title=message)
+        path = tk.filedialog.askopenfilename(initialdir=EXAMPLE_VALUES, title=message)
         if path:
             self.update_dict_from_file(dictionary, string_var, path, lattice_file)
 
     def update_dict_from_file(self, dictionary, string_var, path, lattice_file):
-        with open(path) as file:
-            dictionary.clear()
-            json_dict = json.load(file)
-            if lattice_file:
-                json_dict = json_dict["elements"]
-                json_dict = {short2epics[short]: attributes["k1"] for short, attributes in json_dict.items() if attributes["type"] == "Quad" and short != "QIT6"}
-            dictionary.update(json_dict)
-            string_var.set(path)
+        try:
+            json_dict = lattice_store.get_values(path, lattice_file)
+        except (LatticeFileError, OSError) as error:
+            print(error)
+            return
+        self.multiknob_engine = None
+        dictionary.clear()
+        dictionary.update(json_dict)
+        string_var.set(path)
 
     def compute_new_PS_values(self, quad_values):
         if set(quad_values.keys()).issubset(set(self.ref_PS_values.keys())):
+            conversion = QuadConversion(self.ref_quad_values, self.ref_PS_values)
+            new_PS, ratio, changed = conversion.compute(conversion.to_array(quad_values))
             self.new_PS_values.clear()
-            for key in quad_values:
-                if quad_values[key] != self.ref_quad_values[key]:
-                    print(quad_values[key], self.ref_quad_values[key])
-                    self.new_PS_values[key] = quad_values[key] * self.ref_PS_values[key] / self.ref_quad_values[key]
-            print(self.new_PS_values)
+            self.new_PS_values.update(conversion.to_dict(new_PS, changed))
+            self.computed_quad_values = quad_values
+            # new_PS_values no longer match the engine, the next knob step rebuilds it from scratch
+            self.multiknob_engine = None
         else:
             print("Different Magnets!", set(quad_values.keys()) - set(self.ref_PS_values.keys()))
 
-    def compute_multiknob_new_quad_values(self):
-        if self.new_quad_values.keys() == self.second_new_quad_values.keys():
-            self.multiknob_new_quad_values.clear()
-            self.multiknob_new_quad_values.update(self.new_quad_values)
-            for key in self.new_quad_values:
-                if self.new_quad_values[key] != self.second_new_quad_values[key]:
-                    self.multiknob_new_quad_values[key] = (1 - self.multiknob.get()) * self.new_quad_values[key] + self.multiknob.get() * self.second_new_quad_values[key]
-            print(self.multiknob_new_quad_values)
-        else:
-            print("Multiknob lattices do not have the same Magnet!")
+    def write_PS_values(self, PS_values, restore=None, n_steps=1):
+        try:
+            self.PS_writer.write({magnet + ':set': value for magnet, value in PS_values.items()}, n_steps=n_steps,
+                                 step_time=RAMP_STEP_TIME, restore=restore)
+        except WriteError as error:
+            print(f'Setting PS values failed: {error}')
 
     def set_new_PS_values(self):
-        for magnet, value in self.new_PS_values.items():
-            caput(magnet + ':set', value)
+        if not self.saved_PS_values:
+            self.save_all_PS_values()
+        restore = {magnet + ':set': value for magnet, value in self.saved_PS_values.items()}
+        self.write_PS_values(self.new_PS_values, restore=restore, n_steps=RAMP_STEPS)
+
+    def get_current_PS_values(self):
+        """ all quad setpoints from the monitors, one batched read as long as not all monitors have a value yet """
+        values = self.PS_monitor.snapshot() if self.PS_monitor.is_complete() else self.PS_setpoints.get_all()
+        return {magnet: values[magnet + ':set'] for magnet in quad_list_epics}
 
     def save_all_PS_values(self):
-        self.saved_PS_values = {}
-        for magnet in quad_list_epics:
-            self.saved_PS_values[magnet] = caget(magnet + ':set')
+        self.saved_PS_values = self.get_current_PS_values()
 
     def set_saved_PS_values(self):
-        for magnet, value in self.saved_PS_values.items():
-            caput(magnet + ':set', value)
+        self.write_PS_values(self.saved_PS_values, n_steps=RAMP_STEPS)
 
     def save_current_PS_values_to_file(self):
-        current_ps_values = {}
-        for magnet in quad_list_epics:
-            current_ps_values[magnet] = caget(magnet + ':set')
+        current_ps_values = self.get_current_PS_values()
         print(current_ps_values)
         print('save current_ps_values ps values to file')
         with filedialog.asksaveasfile(initialdir=os.path.dirname(os.path.abspath(__file__)), title='Save current PS values') as file:
@@ -194,4 +279,8 @@ class GUI:
 
 
 if __name__ == '__main__':
-    GUI().master.mainloop()
+    if '--simulate' in sys.argv:
+        from bessy2tools.machine.simulation import VirtualBessy
+        GUI(VirtualBessy(latency=0.002)).master.mainloop()
+    else:
+        GUI().master.mainloop()
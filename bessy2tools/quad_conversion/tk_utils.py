@@ -48,6 +48,65 @@ class ScrollSpinbox(tk.Spinbox):
         elif event.num == 4 or event.delta > 0:
             self.invoke('buttonup')
 
+class TreeviewRows:
+    """
+    Row model of a ttk.Treeview keyed by item id. It remembers the values shown, updates are collected and
+    flushed once when Tk is idle, and only rows to insert or delete and cells whose displayed value changed are sent
+    to Tk. Floats are displayed rounded to digits.
+    """
+
+    def __init__(self, tree_view, columns, digits=3):
+        self.tree_view = tree_view
+        self.columns = list(columns)
+        self.digits = digits
+        self.shown = {}  # item id -> displayed values, in display order
+        self.rows = {}  # item id -> values to display
+        self.flush_id = None
+
+    def format(self, values):
+        return tuple(round(x, self.digits) if isinstance(x, float) else x for x in values)
+
+    def set_rows(self, rows):
+        """ the complete content of the view: dict item id -> values, in display order """
+        self.rows = {iid: self.format(values) for iid, values in rows.items()}
+        self.schedule_flush()
+
+    def set_cells(self, iid, cells):
+        """ dict column -> value for an existing row, ignored if the row is not part of the view """
+        if iid in self.rows:
+            values = list(self.rows[iid])
+            for column, value in cells.items():
+                values[self.columns.index(column)] = value
+            self.rows[iid] = self.format(values)
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.flush_id is None:
+            self.flush_id = self.tree_view.after_idle(self.flush)
+
+    def flush(self):
+        self.flush_id = None
+        removed = [iid for iid in self.shown if iid not in self.rows]
+        if removed:
+            self.tree_view.delete(*removed)
+            for iid in removed:
+                del self.shown[iid]
+
+        for index, (iid, values) in enumerate(self.rows.items()):
+            shown = self.shown.get(iid)
+            if shown is None:
+                self.tree_view.insert('', index, iid, values=values)
+            else:
+                for column, value, shown_value in zip(self.columns, values, shown):
+                    if value != shown_value:
+                        self.tree_view.set(iid, column, value)
+        if list(self.shown) != list(self.rows):
+            for index, iid in enumerate(self.rows):
+                if iid in self.shown and self.tree_view.index(iid) != index:
+                    self.tree_view.move(iid, '', index)
+        self.shown = dict(self.rows)
+
+
 def grid_configure(widget, N, M, weight_row=None, weight_col=None):
     for i in range(N):
         widget.grid_rowconfigure(i, weight=1 if weight_row is None else weight_row[i])
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from bessy2tools.extract_quad_values import mmltools, synthetic
+from bessy2tools.extract_quad_values.cache import ATRingCache
+
+N_SECTORS = 4
+N_FIT_ITERATIONS = 3
+
+
+@pytest.fixture(scope='module')
+def locofile(tmp_path_factory):
+    filename = tmp_path_factory.mktemp('locofiles') / 'bessy2.mat'
+    synthetic.write_at_ring_with_ao(filename, n_sectors=N_SECTORS, n_fit_iterations=N_FIT_ITERATIONS, seed=1)
+    return filename
+
+
+def expected_quad_strengths(seed=1):
+    """ average K per power supply of the last fit iteration, straight from the synthetic lattice """
+    lattice = synthetic.make_lattice('BESSYII', N_SECTORS)
+    ring = synthetic.make_at_ring_with_ao(n_sectors=N_SECTORS, n_fit_iterations=N_FIT_ITERATIONS,
+                                          seed=seed)['RINGs'][0, -1]['ring'][0]
+    strengths = {}
+    for (_, family, ps_name, _), element in zip(lattice, ring):
+        if family in synthetic.QUAD_K['BESSYII']:
+            strengths.setdefault(ps_name, []).append(element['K'])
+    return {ps_name: np.mean(values) for ps_name, values in strengths.items()}
+
+
+def assert_name_maps_equal(a, b):
+    for column in mmltools.NameMap._columns:
+        np.testing.assert_array_equal(getattr(a, column), getattr(b, column))
+
+
+def assert_ring_tables_equal(a, b):
+    for column in mmltools.RingTable.columns:
+        np.testing.assert_array_equal(getattr(a, column), getattr(b, column))
+    for column in mmltools.RingTable.fields:
+        np.testing.assert_array_equal(a.valid[column], b.valid[column])
+
+
+def test_lazy_eager_and_categorical_agree(locofile):
+    eager = mmltools.ATRingWithAO(locofile)
+    lazy = mmltools.ATRingWithAO(locofile, lazy=True)
+    categorical = mmltools.ATRingWithAO(locofile, categorical=True)
+    assert eager.n_fit_iterations == lazy.n_fit_iterations == N_FIT_ITERATIONS
+    assert_name_maps_equal(eager.name_map, lazy.name_map)
+    assert_name_maps_equal(eager.name_map, categorical.name_map)
+    for fit_iteration in range(N_FIT_ITERATIONS):
+        assert_ring_tables_equal(eager.get_ring_table(fit_iteration), lazy.get_ring_table(fit_iteration))
+    for at_type in ('QUAD', 'SEXT'):
+        np.testing.assert_array_equal(eager.name_map.get_ps_names(at_type),
+                                      categorical.name_map.get_ps_names(at_type))
+        groups = categorical.name_map.get_at_indices_grouped(at_type=at_type)
+        for ps_name, at_indices in eager.name_map.get_at_indices_grouped(at_type=at_type).items():
+            np.testing.assert_array_equal(at_indices, groups[ps_name])
+    strengths = eager.get_magnet_strength()
+    assert lazy.get_magnet_strength() == strengths
+    assert categorical.get_magnet_strength() == strengths
+
+
+def test_get_magnet_strength_per_power_supply(locofile):
+    lwa = mmltools.ATRingWithAO(locofile)
+    expected = {}
+    for ps_name, k1 in expected_quad_strengths().items():
+        expected.update(lwa._get_magnet_strength(ps_name, k1, 'QUAD'))
+    strengths = lwa.get_magnet_strength()
+    assert strengths.keys() == expected.keys()
+    for name, magnet in expected.items():
+        assert strengths[name]['length'] == magnet['length']
+        assert strengths[name]['k1'] == pytest.approx(magnet['k1'], rel=1e-12)
+
+
+def test_cache_round_trip(locofile, tmp_path):
+    cache = ATRingCache(tmp_path / 'cache')
+    lwa = mmltools.ATRingWithAO(locofile)
+    for cached in (cache.load(locofile), cache.load(locofile)):
+        assert cached.machine == lwa.machine
+        assert cached.n_fit_iterations == lwa.n_fit_iterations
+        assert_name_maps_equal(cached.name_map, lwa.name_map)
+        for fit_iteration in range(N_FIT_ITERATIONS):
+            assert_ring_tables_equal(cached.get_ring_table(fit_iteration), lwa.get_ring_table(fit_iteration))
+        assert cached.get_magnet_strength() == lwa.get_magnet_strength()
+    assert len(list(cache.get_entry(locofile).glob('ring_*'))) == N_FIT_ITERATIONS
+
+
+def test_cache_evicts_least_recently_used(locofile, tmp_path):
+    other = tmp_path / 'other.mat'
+    synthetic.write_at_ring_with_ao(other, n_sectors=N_SECTORS, n_fit_iterations=N_FIT_ITERATIONS, seed=2)
+    cache = ATRingCache(tmp_path / 'cache', max_size=1)
+    first = cache.load(locofile)
+    assert first.entry.exists()
+    second = cache.load(other)
+    # the entry in use is kept although it alone is larger than max_size
+    assert not first.entry.exists()
+    assert [entry for entry in cache.directory.glob('*-v*')] == [second.entry]
+    assert second.get_ring_table(0) is second.get_ring_table(0)
+    assert second.entry.exists() and (second.entry / 'ring_0').exists()
+    # the remembered hash of an evicted entry goes with it
+    evicted_hash = first.entry.name.rsplit('-v', 1)[0]
+    assert all(memo.read_text() != evicted_hash for memo in (cache.directory / 'hashes').iterdir())
+    # an evicted entry still works, its tables are decoded from the .mat file again
+    assert_ring_tables_equal(first.get_ring_table(0), mmltools.ATRingWithAO(locofile).get_ring_table(0))
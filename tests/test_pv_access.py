@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from bessy2tools.machine.pv_access import LocalBackend, MonitorCache, SetpointWriter, WriteError
+
+
+class RecordingBackend(LocalBackend):
+    """ remembers every put, the first n_failures puts raise like a disconnected channel """
+
+    def __init__(self, *args, n_failures=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.puts = []
+        self.n_failures = n_failures
+
+    def put_many(self, pvnames, values, callback=None):
+        if self.n_failures:
+            self.n_failures -= 1
+            raise Exception('put failed')
+        self.puts.append(dict(zip(pvnames, values)))
+        super().put_many(pvnames, values, callback)
+
+
+def test_write_waits_for_relaxing_readbacks():
+    backend = LocalBackend({'Q1:set': 0.0, 'Q1:rdbk': 0.0, 'Q2:set': 0.0, 'Q2:rdbk': 0.0}, latency=0.01,
+                           relaxation_time=0.05, update_interval=0.01)
+    SetpointWriter(backend, tolerance=1e-3, timeout=2.0).write({'Q1:set': 1.0, 'Q2:set': -2.0})
+    q1, q2 = backend.get_many(['Q1:rdbk', 'Q2:rdbk'])
+    assert q1 == pytest.approx(1.0, abs=1e-3)
+    assert q2 == pytest.approx(-2.0, abs=1e-3)
+
+
+def test_ramp_writes_interpolated_steps():
+    backend = RecordingBackend({'Q1:set': 0.0, 'Q1:rdbk': 0.0, 'Q2:set': 4.0, 'Q2:rdbk': 4.0})
+    SetpointWriter(backend, timeout=2.0).write({'Q1:set': 1.0, 'Q2:set': 0.0}, n_steps=4)
+    np.testing.assert_allclose([put['Q1:set'] for put in backend.puts], [0.25, 0.5, 0.75, 1.0])
+    np.testing.assert_allclose([put['Q2:set'] for put in backend.puts], [3.0, 2.0, 1.0, 0.0])
+
+
+def test_verify_tolerance():
+    # readbacks are not updated by this backend, they stay 5e-3 off the new setpoint
+    values = {'Q1:set': 0.0, 'Q1:rdbk': 1.005}
+    SetpointWriter(LocalBackend(values, readback=None), tolerance=1e-2, timeout=0.2).write({'Q1:set': 1.0})
+    with pytest.raises(WriteError, match='Q1:rdbk'):
+        SetpointWriter(LocalBackend(values, readback=None), tolerance=1e-3, timeout=0.2).write({'Q1:set': 1.0})
+
+
+def test_restore_after_put_failure():
+    backend = RecordingBackend({'Q1:set': 0.0, 'Q1:rdbk': 0.0}, n_failures=1)
+    with pytest.raises(WriteError, match='Put failed'):
+        SetpointWriter(backend, timeout=1.0).write({'Q1:set': 1.0}, restore={'Q1:set': 0.0})
+    assert backend.puts == [{'Q1:set': 0.0}]
+    assert backend.get_many(['Q1:set', 'Q1:rdbk']) == [0.0, 0.0]
+
+
+def test_restore_after_readback_failure():
+    # the readback does not follow the new setpoint, but is still at the previous one
+    backend = RecordingBackend({'Q1:set': 0.0, 'Q1:rdbk': 0.0}, readback=None)
+    with pytest.raises(WriteError, match='Readbacks out of tolerance'):
+        SetpointWriter(backend, timeout=0.2).write({'Q1:set': 1.0}, restore={'Q1:set': 0.0})
+    assert backend.puts == [{'Q1:set': 1.0}, {'Q1:set': 0.0}]
+    assert backend.get_many(['Q1:set']) == [0.0]
+
+
+def test_monitor_cache_pop_changed():
+    backend = LocalBackend({'A': 1.0, 'B': 2.0})
+    cache = MonitorCache(['A', 'B'], backend)
+    assert cache.is_complete()
+    assert cache.pop_changed() == {'A': 1.0, 'B': 2.0}
+    assert cache.pop_changed() == {}
+    backend.update({'B': 3.0})
+    backend.update({'B': 4.0})
+    assert cache.pop_changed() == {'B': 4.0}
+    assert cache.snapshot() == {'A': 1.0, 'B': 4.0}
@@ -0,0 +1,59 @@
+import threading
+
+import pytest
+
+from bessy2tools.machine.pv_access import LocalBackend
+from bessy2tools.machine.settle import Settle
+
+LIFETIME = 'CUMZR:rdLt'
+
+
+def relaxing_backend():
+    return LocalBackend({'S1:set': 0.0, 'S1:rdbk': 0.0, LIFETIME: 8.0}, latency=0.01, relaxation_time=0.05,
+                        update_interval=0.01)
+
+
+def test_settles_on_relaxing_backend():
+    backend = relaxing_backend()
+    settle = Settle({LIFETIME: 0.01}, backend=backend, tolerance=1e-2, window=0.1, timeout=2.0)
+    backend.put_many(['S1:set'], [1.0])
+    backend.relax({LIFETIME: 9.0}, 0.05)
+    assert settle.wait({'S1:set': 1.0})
+    assert settle.values['S1:rdbk'] == pytest.approx(1.0, abs=1e-2)
+    assert settle.values[LIFETIME] == pytest.approx(9.0, abs=0.02)
+    assert settle.last_duration >= settle.window
+
+
+def test_timeout_if_readback_does_not_follow():
+    backend = LocalBackend({'S1:set': 0.0, 'S1:rdbk': 0.0}, readback=None)
+    settle = Settle(backend=backend, timeout=0.2)
+    backend.put_many(['S1:set'], [1.0])
+    assert not settle.wait({'S1:set': 1.0})
+
+
+def test_timeout_if_signal_keeps_changing():
+    backend = relaxing_backend()
+    settle = Settle({LIFETIME: 0.01}, backend=backend, window=0.1, timeout=0.3)
+    stop = threading.Event()
+
+    def jitter():
+        value = 8.0
+        while not stop.wait(0.02):
+            value = -value
+            backend.update({LIFETIME: value})
+
+    thread = threading.Thread(target=jitter)
+    thread.start()
+    try:
+        assert not settle.wait()
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_timeout_without_signal_value():
+    backend = LocalBackend({'S1:set': 0.0, 'S1:rdbk': 0.0, LIFETIME: None})
+    settle = Settle({LIFETIME: 0.01}, backend=backend, window=0.05, timeout=0.2)
+    assert not settle.wait({'S1:set': 0.0})
+    backend.update({LIFETIME: 8.0})
+    assert settle.wait({'S1:set': 0.0})
@@ -1,10 +1,31 @@
+import sys
 import numpy as np
-from scipy.optimize import minimize
-from epics import PV
 import time
 
+from bessy2tools.instrumentation import metrics
+from bessy2tools.machine.evaluation_log import EvaluationLog
+from bessy2tools.machine.optimizer import RCDS, AveragedObjective
+from bessy2tools.machine.pv_access import EpicsBackend, SinglePV, SampleCollector
+from bessy2tools.machine.settle import Settle
+
 print('start tune optimizer')
 
+# --metrics file.prom (or .jsonl) records the latency of every PV read and write and of the optimizer steps,
+# a summary is printed on exit
+if '--metrics' in sys.argv:
+    metrics.enable(sys.argv[sys.argv.index('--metrics') + 1], export_interval=60)
+
+if '--simulate' in sys.argv:
+    from bessy2tools.machine.simulation import VirtualBessy
+    backend = VirtualBessy()
+else:
+    backend = EpicsBackend()
+
+
+def PV(pvname):
+    return SinglePV(pvname, backend)
+
+
 tune_x = PV('TUNEZR:rdH')
 tune_y = PV('TUNEZR:rdV')
 tune_put = PV('TUNEXPV:sign_apply')
@@ -18,28 +39,51 @@ magnets = (
 )
 
 lifetime = PV('TOPUPCC:rdLT')
-
-initial_values = np.array([magnet.get() for magnet in magnets])
-diff = 0.0005
-bounds = ((value * (1 - diff), value * (1 + diff)) for value in initial_values)
+# every lifetime sample is a new monitor update, the PV updates more slowly than it could be polled
+lifetime_updates = SampleCollector([lifetime.pvname], backend)
+
+# every evaluation goes to an append-only log:
+# --resume replays the latest session from the log (same initial values, bounds, start and noise) and continues it on
+#   the machine where it was interrupted
+# --warm-start starts from the best point of all earlier sessions within the bounds and reuses their evaluations
+# otherwise only evaluations of the running session are reused, earlier sessions saw a different machine
+log = EvaluationLog(sys.argv[sys.argv.index('--log') + 1] if '--log' in sys.argv else 'tune_optimizer.jsonl')
+
+if '--resume' in sys.argv:
+    session = log.resume_session()
+    initial_values = np.array(session['initial'])
+    bounds = session['bounds']
+    start_values = np.array(session['start'])
+else:
+    initial_values = np.array([magnet.get() for magnet in magnets])
+    diff = 0.0005
+    # a list, the generator was exhausted after its first use; sorted so that negative values get valid bounds
+    bounds = [sorted((value * (1 - diff), value * (1 + diff))) for value in initial_values]
+    start_values = initial_values
+    best = log.best(bounds) if '--warm-start' in sys.argv else None
+    if best is not None:
+        print(f'warm start from {best["x"]} of session {best["session"]}, lifetime {-best["value"]} h')
+        start_values = np.array(best['x'])
+    log.start_session(initial_values, bounds, start_values, warm_start='--warm-start' in sys.argv)
 
 print(initial_values)
 
+# after a step the readbacks have to reach the setpoints (within a tenth of the bound width) and the lifetime has to be
+# stable for a second, at most 10 seconds
+settle = Settle({lifetime.pvname: 0.05}, backend=backend, window=1.0, timeout=10.0,
+                tolerance={magnet.pvname: 0.1 * (upper - lower) for magnet, (lower, upper) in zip(magnets, bounds)})
+
 for magnet in magnets:
     print(magnet.pvname, magnet.get())
 
 counter = 0
 
 
-def fitness(*args):
-    while current.get() < 3:
-        print('wait for 5 seconds, paul please give me new current!')
-        time.sleep(5)
-        return 1000
-
-    for magnet, value in zip(magnets, *args):
+def set_magnets(values):
+    for magnet, value in zip(magnets, values):
         magnet.put(value)
         print(f'set {magnet.pvname} to {value}')
+    setpoints = {magnet.pvname: value for magnet, value in zip(magnets, values)}
 
     global counter
     if not counter % 20:
@@ -48,10 +92,31 @@ def fitness(*args):
         else:
             tune_put.put(-1)
 
-    time.sleep(2)
+    settle.wait(setpoints)
     counter += 1
 
-    return -lifetime.get()
+
+def measure_lifetime():
+    while current.get() < 3:
+        print('wait for 5 seconds, paul please give me new current!')
+        time.sleep(5)
+
+    samples = lifetime_updates.collect(1, timeout=10.0)[lifetime.pvname]
+    if not samples:
+        raise Exception(f'No update of {lifetime.pvname} within 10 s')
+    return -samples[0]
+
+
+def readings():
+    return dict(tune_x=tune_x.get(), tune_y=tune_y.get(), current=current.get())
+
+
+# the lifetime is averaged over 3 to 10 updates per setting, until its standard error is below 0.05 h
+# settings within a hundredth of the bound width of an evaluation of this session (or of all sessions with
+# --warm-start) are not measured again
+fitness = AveragedObjective(set_magnets, measure_lifetime, min_samples=3, max_samples=10, sem_target=0.05,
+                            log=log, readings=readings,
+                            tolerance=np.array([0.01 * (upper - lower) for lower, upper in bounds]))
 
 
 def rest_to_initial():
@@ -75,7 +140,22 @@ try:
     #         tune_put.put(-1)
     #         tune_put.put(-1)
 
-    res = minimize(fitness, initial_values, bounds=bounds, method='Nelder-Mead')
+    # the start point is measured three times, the spread of the averaged lifetimes is the noise RCDS has to tolerate
+    # (a resumed session reuses them, so that RCDS retraces its logged steps)
+    if 'noise' in log.sessions[log.session]:
+        start_fitness, noise = log.sessions[log.session]['start_value'], log.sessions[log.session]['noise']
+    else:
+        start_fitness, noise = fitness.estimate_noise(start_values, n_repeats=3)
+        log.update_session(start_value=start_fitness, noise=noise)
+    print(f'lifetime {-start_fitness} h, noise {noise} h')
+    optimizer = RCDS(fitness, bounds, noise=noise, step=0.1, max_evaluations=300)
+    best_values, best_fitness = optimizer.run(start_values, f0=start_fitness)
+    print(f'best lifetime {-best_fitness} h after {optimizer.n_evaluations} evaluations, '
+          f'{fitness.n_reused} taken from the log')
+    set_magnets(best_values)
 
 except:
     rest_to_initial()
+
+finally:
+    log.close()